@@ -0,0 +1,153 @@
+import image_builder as ib
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import standin
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CASES = {}
+
+def case(name, repeat=5, root=False, **params):
+    def wrap(f):
+        CASES[name] = { "run": f, "repeat": repeat, "root": root, "params": params }
+        return f
+    return wrap
+
+@ib.buildcmd()
+@ib.buildcmd_flatten()
+class noop(object):
+    def run(self, s):
+        pass
+
+@ib.buildcmd()
+class noop_logged(object):
+    def run(self, s, i):
+        s.debug("noop %d", i)
+
+@case("dispatch.flatten", calls=20000)
+def dispatch_flatten(work, calls):
+    with ib.builder() as s:
+        start = time.perf_counter()
+        for i in range(calls):
+            noop(s)
+        return time.perf_counter() - start
+
+@case("dispatch.logged", calls=5000)
+def dispatch_logged(work, calls):
+    with ib.builder() as s:
+        start = time.perf_counter()
+        for i in range(calls):
+            noop_logged(s, i)
+        return time.perf_counter() - start
+
+@case("empty_image", images=200, size=ib.IMAGE_SIZE)
+def empty_image(work, images, size):
+    with ib.builder() as s:
+        start = time.perf_counter()
+        for i in range(images):
+            ib.empty_image(s, os.path.join(work, "%d.img" % i), size)
+        return time.perf_counter() - start
+
+def install_tree(s, from_path, to_path):
+    uid, gid = os.getuid(), os.getgid()
+    ib.file.install_dir(s, to_path, uid, gid, 0o755)
+    for root, dirs, files in os.walk(from_path):
+        dest = os.path.join(to_path, os.path.relpath(root, from_path))
+        for d in dirs:
+            ib.file.install_dir(s, os.path.join(dest, d), uid, gid, 0o755)
+        for f in files:
+            ib.file.install(s, os.path.join(root, f), os.path.join(dest, f), uid, gid, 0o644)
+
+@case("file.install", files=5000)
+def file_install(work, files):
+    standin.tree(os.path.join(work, "src"), files)
+    with ib.builder() as s:
+        start = time.perf_counter()
+        install_tree(s, os.path.join(work, "src"), os.path.join(work, "dst"))
+        return time.perf_counter() - start
+
+@case("file.copy_r", files=5000)
+def file_copy_r(work, files):
+    standin.tree(os.path.join(work, "src"), files)
+    with ib.builder() as s:
+        start = time.perf_counter()
+        ib.file.copy_r(s, os.path.join(work, "src"), os.path.join(work, "dst"), symlinks=True)
+        return time.perf_counter() - start
+
+@case("file.sync_tree", files=5000)
+def file_sync_tree(work, files):
+    standin.tree(os.path.join(work, "src"), files)
+    with ib.builder() as s:
+        start = time.perf_counter()
+        ib.file.sync_tree(s, os.path.join(work, "src"), os.path.join(work, "dst"))
+        return time.perf_counter() - start
+
+@case("subprocess.output", lines=1000000)
+def subprocess_output(work, lines):
+    with ib.builder() as s:
+        start = time.perf_counter()
+        ib.check_subprocess(s, [ 'seq', '%d' % lines ])
+        return time.perf_counter() - start
+
+@case("subprocess.spawn", calls=200)
+def subprocess_spawn(work, calls):
+    with ib.builder() as s:
+        start = time.perf_counter()
+        for i in range(calls):
+            ib.check_subprocess(s, [ 'true' ])
+        return time.perf_counter() - start
+
+def package(output, name, version, files, prefix):
+    control = { "Package": name, "Version": version, "Architecture": "armhf",
+                "Maintainer": "bench <bench@localhost>", "Description": "benchmark package" }
+    with ib.builder() as s:
+        tmp = ib.mkdtemp(s, os.path.dirname(output)).path
+        standin.tree(tmp, files, seed=len(name))
+        ib.deb.build(s, output, control, ib.deb.tree(tmp, prefix))
+
+def build_sdcard_fixture(work):
+    os.symlink(os.path.join(REPO, "overlay"), os.path.join(work, "overlay"))
+    shutil.copy(os.path.join(REPO, "overlay.rules"), work)
+    packages = os.path.join(work, "packages")
+    os.mkdir(packages)
+    package(os.path.join(packages, "raspberrypi-firmware-git-bench-1_armhf.deb"),
+            "raspberrypi-firmware-git", "bench-1", 100, "/boot/firmware")
+    package(os.path.join(packages, "linux-image-%s_1_armhf.deb" % standin.KERNEL),
+            "linux-image-%s" % standin.KERNEL, "1", 200, "/lib/modules/%s" % standin.KERNEL)
+    for board in [ "pi2", "pi3" ]:
+        package(os.path.join(packages, "u-boot-%s-git-bench-1_armhf.deb" % board),
+                "u-boot-%s-git" % board, "bench-1", 4, "/usr/lib/u-boot")
+
+def build_sdcard(work, assembly, boards):
+    env = dict(os.environ, IMAGE_ASSEMBLY=assembly, MIRROR_SNAPSHOT="bench",
+               MIRROR="http://debian.invalid/debian/", PYTHONPATH=REPO)
+    # staging installs root-owned files, which fakeroot fakes for a normal user
+    cmd = [ sys.executable, os.path.join(REPO, "build_sdcard.py") ] + boards
+    if os.geteuid() != 0:
+        cmd = [ 'fakeroot' ] + cmd
+    start = time.perf_counter()
+    with open(os.path.join(work, "build_sdcard.log"), "ab") as log:
+        ret = subprocess.call(cmd,
+                cwd=work, env=env, stdin=subprocess.DEVNULL, stdout=log, stderr=log)
+    if ret != 0:
+        raise ib.BuilderError("build_sdcard.py returned %d (see %s)" % (ret, os.path.join(work, "build_sdcard.log")))
+    return time.perf_counter() - start
+
+@case("build_sdcard.tree.cold", repeat=3, boards=[ "pi2", "pi3" ])
+def build_sdcard_tree_cold(work, boards):
+    build_sdcard_fixture(work)
+    return build_sdcard(work, "tree", boards)
+
+@case("build_sdcard.tree.warm", repeat=3, boards=[ "pi2", "pi3" ])
+def build_sdcard_tree_warm(work, boards):
+    build_sdcard_fixture(work)
+    build_sdcard(work, "tree", boards)
+    return build_sdcard(work, "tree", boards)
+
+@case("build_sdcard.mount.cold", repeat=3, root=True, boards=[ "pi2" ])
+def build_sdcard_mount_cold(work, boards):
+    build_sdcard_fixture(work)
+    return build_sdcard(work, "mount", boards)
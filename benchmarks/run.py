@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+# Runs the image_builder benchmarks and stores the results as JSON.
+#
+#   benchmarks/run.py [-o results.json] [-b baseline.json] [-t 0.10] [name ...]
+#
+# Names may be fnmatch patterns ("file.*"). Every run of every case happens in
+# a fresh interpreter with its own scratch directory, state directory and the
+# stand-in tools from standin.py first on PATH. With -b, each median is
+# compared to the baseline's and anything slower by more than the threshold is
+# flagged, unless either side has fewer than MIN_RUNS runs; the exit status is
+# 1 if there were regressions.
+
+import argparse
+import datetime
+import fnmatch
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+RESULTS = os.path.join(HERE, "results")
+# differences below this are timer noise whatever the ratio
+NOISE_FLOOR = 0.005
+# a median over fewer runs than this isn't trusted to fail a comparison
+MIN_RUNS = 3
+
+sys.path.insert(0, REPO)
+
+def child(name):
+    import cases
+    c = cases.CASES[name]
+    seconds = c["run"](os.environ['BENCH_WORK'], **c["params"])
+    print(json.dumps({ "seconds": seconds }))
+    return 0
+
+def tools(directory):
+    import standin
+    os.makedirs(directory)
+    for name in standin.TOOLS:
+        os.symlink(os.path.join(HERE, "standin.py"), os.path.join(directory, name))
+
+def run_once(name, scratch):
+    work = tempfile.mkdtemp(dir=scratch, prefix="%s-" % name)
+    env = dict(os.environ,
+               PATH=os.path.join(scratch, "bin") + os.pathsep + os.environ.get('PATH', ''),
+               PYTHONPATH=REPO,
+               BENCH_WORK=work,
+               BENCH_STATE=os.path.join(work, ".state"),
+               IMAGE_BUILDER_STATE=os.path.join(work, ".image_builder"),
+               LOOP_CONTROL=os.path.join(work, ".state", "loop-control"),
+               BUILD_LOG_DIR=os.path.join(work, ".logs"))
+    env.pop('BUILD_TRACE', None)
+    with open(os.path.join(work, ".stderr"), "wb") as err:
+        proc = subprocess.run([ sys.executable, os.path.abspath(__file__), "--child", name ],
+                env=env, cwd=work, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=err)
+    if proc.returncode != 0:
+        with open(os.path.join(work, ".stderr"), "rb") as f:
+            tail = f.read().decode('utf-8', 'replace').splitlines()[-20:]
+        raise RuntimeError("%s failed with %d:\n    %s" % (name, proc.returncode, "\n    ".join(tail)))
+    result = json.loads(proc.stdout.decode('utf-8').strip().splitlines()[-1])
+    shutil.rmtree(work)
+    return result["seconds"]
+
+def git_commit():
+    proc = subprocess.run([ 'git', '-C', REPO, 'rev-parse', '--short', 'HEAD' ],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return proc.stdout.decode('utf-8').strip() or None
+
+def compare(results, baseline, threshold):
+    regressions = []
+    print("%-28s %10s %10s %8s" % ("benchmark", "median", "baseline", "change"))
+    for name, r in results.items():
+        if "median" not in r:
+            print("%-28s %10s" % (name, r.get("skipped", "-")))
+            continue
+        b = baseline.get(name, {}).get("median")
+        if b is None:
+            print("%-28s %9.3fs %10s" % (name, r["median"], "-"))
+            continue
+        change = r["median"] / b - 1 if b else 0.0
+        flag = ""
+        if min(len(r["runs"]), len(baseline[name].get("runs", []))) < MIN_RUNS:
+            flag = "  (too few runs)"
+        elif change > threshold and r["median"] - b > NOISE_FLOOR:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print("%-28s %9.3fs %9.3fs %+7.1f%%%s" % (name, r["median"], b, change * 100, flag))
+    return regressions
+
+def main(argv):
+    if len(argv) == 3 and argv[1] == "--child":
+        return child(argv[2])
+
+    import cases
+    parser = argparse.ArgumentParser(description="Benchmark image_builder")
+    parser.add_argument("names", nargs="*", help="benchmarks to run (fnmatch patterns)")
+    parser.add_argument("-o", "--output", help="results file (default: benchmarks/results/<time>-<commit>.json)")
+    parser.add_argument("-b", "--baseline", help="results file to compare against")
+    parser.add_argument("-t", "--threshold", type=float, default=0.10, help="relative slowdown flagged as a regression")
+    parser.add_argument("-r", "--repeat", type=int, help="override the number of runs per benchmark")
+    parser.add_argument("-l", "--list", action="store_true", help="list benchmarks and exit")
+    args = parser.parse_args(argv[1:])
+
+    names = [ n for n in cases.CASES if not args.names or any(fnmatch.fnmatch(n, p) for p in args.names) ]
+    if args.list:
+        for n in names:
+            print("%-28s %s" % (n, json.dumps(cases.CASES[n]["params"])))
+        return 0
+    if not names:
+        print("No benchmarks match %s" % " ".join(args.names), file=sys.stderr)
+        return 2
+
+    commit = git_commit()
+    report = {
+        "meta": {
+            "time": datetime.datetime.now().isoformat(timespec="seconds"),
+            "commit": commit,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "root": os.geteuid() == 0,
+        },
+        "results": {},
+    }
+    scratch = tempfile.mkdtemp(prefix="image_builder-bench-")
+    tools(os.path.join(scratch, "bin"))
+    try:
+        for name in names:
+            c = cases.CASES[name]
+            entry = { "params": c["params"] }
+            report["results"][name] = entry
+            if c["root"] and os.geteuid() != 0:
+                entry["skipped"] = "needs root"
+                print("%s: skipped (needs root)" % name, file=sys.stderr)
+                continue
+            runs = [ run_once(name, scratch) for i in range(args.repeat or c["repeat"]) ]
+            entry.update({
+                "runs": runs,
+                "min": min(runs),
+                "median": statistics.median(runs),
+                "stdev": statistics.stdev(runs) if len(runs) > 1 else 0.0,
+            })
+            print("%s: median %.3fs over %d runs" % (name, entry["median"], len(runs)), file=sys.stderr)
+    except RuntimeError as e:
+        print(e, file=sys.stderr)
+        print("Keeping %s for inspection" % scratch, file=sys.stderr)
+        return 1
+    shutil.rmtree(scratch)
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS, exist_ok=True)
+        output = os.path.join(RESULTS, "%s-%s.json" % (datetime.datetime.now().strftime("%Y%m%d-%H%M%S"), commit or "unknown"))
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+        f.write("\n")
+    print("Wrote %s" % output, file=sys.stderr)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)["results"]
+    regressions = compare(report["results"], baseline, args.threshold)
+    if regressions:
+        print("%d regression(s): %s" % (len(regressions), ", ".join(regressions)), file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+# Stand-in for the privileged and distribution tools the builders run, so the
+# benchmarks need no root, loop devices or Debian mirror. run.py links every
+# name in TOOLS to this script in a directory at the front of PATH and points
+# LOOP_CONTROL somewhere that doesn't exist, so the loop pool always asks
+# losetup; the tool is picked from argv[0]. Anything that would touch a block
+# device is a no-op.
+
+import os
+import random
+import shutil
+import sys
+
+TOOLS = [ "apt-get", "btrfs", "chroot", "debootstrap", "dpkg", "losetup", "mcopy",
+          "mkfs.btrfs", "mkfs.ext4", "mkfs.fat", "mount", "sfdisk", "umount" ]
+ROOTFS_FILES = int(os.getenv('BENCH_ROOTFS_FILES', '2000'))
+KERNEL = "4.19.0-bench"
+
+def state(name):
+    path = os.path.join(os.environ.get('BENCH_STATE', '/tmp/bench-state'), name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def write(path, data, mode=0o644):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+    os.chmod(path, mode)
+
+# Deterministic tree of files between 256 bytes and 64 KiB, roughly log-uniform,
+# spread over directories of at most per_dir entries.
+def tree(root, files, seed=0, per_dir=64):
+    rng = random.Random(seed)
+    total = 0
+    for i in range(files):
+        size = int(2 ** rng.uniform(8, 16))
+        path = os.path.join(root, "d%03d" % (i // per_dir), "f%05d" % i)
+        write(path, rng.randbytes(size), 0o755 if i % 10 == 0 else 0o644)
+        total += size
+    return total
+
+def rootfs(root):
+    for d in [ "dev", "home", "proc", "root", "run", "sys", "tmp", "mnt",
+               "etc/apt/sources.list.d", "etc/kernel/postinst.d", "etc/systemd/system",
+               "var/cache/apt/archives/partial", "var/lib/apt/lists", "var/lib/dpkg", "usr/sbin" ]:
+        os.makedirs(os.path.join(root, d), exist_ok=True)
+    write(os.path.join(root, "etc", "hostname"), b"debian\n")
+    write(os.path.join(root, "etc", "resolv.conf"), b"nameserver 127.0.0.1\n")
+    write(os.path.join(root, "etc", "passwd"), b"root:x:0:0:root:/root:/bin/bash\n")
+    for key in [ "rsa", "ecdsa", "ed25519" ]:
+        write(os.path.join(root, "etc", "ssh", "ssh_host_%s_key" % key), b"key\n", 0o600)
+        write(os.path.join(root, "etc", "ssh", "ssh_host_%s_key.pub" % key), b"key\n")
+    write(os.path.join(root, "var", "lib", "dpkg", "status"), b"")
+    tree(os.path.join(root, "usr", "lib", "bench"), ROOTFS_FILES, seed=1)
+    tree(os.path.join(root, "boot", "firmware"), max(1, ROOTFS_FILES // 10), seed=2)
+    tree(os.path.join(root, "lib", "modules", KERNEL, "kernel"), max(1, ROOTFS_FILES // 4), seed=3)
+    write(os.path.join(root, "boot", "vmlinuz-%s" % KERNEL), random.Random(4).randbytes(1 << 20))
+    os.symlink("usr/lib/bench", os.path.join(root, "bench"))
+    os.symlink("/usr/lib/bench/d000/f00000", os.path.join(root, "usr", "sbin", "bench"))
+
+def positional(args, valued=()):
+    result = []
+    skip = False
+    for a in args:
+        if skip:
+            skip = False
+        elif a in valued:
+            skip = True
+        elif not a.startswith("-"):
+            result.append(a)
+    return result
+
+def losetup(args):
+    loops = state("loops")
+    if args[0] == "-d":
+        try:
+            os.unlink(os.path.join(loops, os.path.basename(args[1])))
+        except FileNotFoundError:
+            pass
+        return 0
+    paths = positional(args, ("--offset", "--sizelimit", "-o"))
+    if "--find" in args or "-f" in args:
+        # a plain file stands in for the device node, so the pool sees it exist
+        device = os.path.join(state("dev"), "loop%d" % len(os.listdir(loops)))
+        write(device, b"")
+    else:
+        device = paths[0]
+    with open(os.path.join(loops, os.path.basename(device)), "w") as f:
+        print(os.path.abspath(paths[-1]), file=f)
+    if "--show" in args:
+        print(device)
+    return 0
+
+def btrfs(args):
+    if args[:2] == [ "subvolume", "create" ]:
+        os.makedirs(args[2])
+    elif args[:2] == [ "subvolume", "delete" ]:
+        shutil.rmtree(args[2])
+    elif args[:2] == [ "subvolume", "show" ]:
+        return 1
+    return 0
+
+# A mounted filesystem's contents go away with it, so umount empties the
+# mount point again. Bind mounts are left alone: the target only ever showed
+# the source.
+def mount(args):
+    target = os.path.abspath(positional(args, ("-t", "-o"))[-1])
+    options = args[args.index("-o") + 1].split(",") if "-o" in args else []
+    if "remount" in options:
+        return 0
+    with open(os.path.join(state("mounts"), target.replace("/", "_")), "w") as f:
+        print("bind" if "--bind" in args or "bind" in options else "fs", file=f)
+    return 0
+
+def umount(args):
+    target = os.path.abspath(positional(args)[-1])
+    record = os.path.join(state("mounts"), target.replace("/", "_"))
+    try:
+        with open(record, "r") as f:
+            kind = f.read().strip()
+        os.unlink(record)
+    except FileNotFoundError:
+        return 0
+    if kind == "fs":
+        for entry in os.listdir(target):
+            path = os.path.join(target, entry)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+    return 0
+
+def chroot(args):
+    root, cmd, args = args[0], os.path.basename(args[1]), args[2:]
+    inside = lambda p: os.path.join(root, p.lstrip("/"))
+    if cmd == "rm":
+        for a in positional(args):
+            os.unlink(inside(a))
+    elif cmd == "ln":
+        target, link = positional(args)
+        os.symlink(target, inside(link))
+    elif cmd == "useradd":
+        os.makedirs(inside(os.path.join("/home", positional(args, ("-s",))[-1])), exist_ok=True)
+    elif cmd == "dpkg":
+        return dpkg(args)
+    elif not sys.stdin.isatty():
+        sys.stdin.read()
+    return 0
+
+def dpkg(args):
+    if "--print-architecture" in args:
+        print("armhf")
+    return 0
+
+def main(argv):
+    tool = os.path.basename(argv[0])
+    args = argv[1:]
+    if tool == "losetup":
+        return losetup(args)
+    if tool == "btrfs":
+        return btrfs(args)
+    if tool == "mount":
+        return mount(args)
+    if tool == "umount":
+        return umount(args)
+    if tool == "chroot":
+        return chroot(args)
+    if tool == "dpkg":
+        return dpkg(args)
+    if tool == "debootstrap":
+        rootfs(positional(args)[1])
+        return 0
+    if tool == "sfdisk" and not sys.stdin.isatty():
+        sys.stdin.read()
+    # mkfs.*, mcopy and apt-get only have to succeed; the images they would
+    # fill were already allocated by the builder
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
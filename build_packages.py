@@ -3,25 +3,30 @@
 import image_builder as ib
 import os
 import sys
-import pickle
 import subprocess
-import textwrap
 import datetime
 import shutil
 import glob
-import subprocess
+import re
 
 OPJ = os.path.join
 
 UBOOT_VER = "v2017.03-rc2"
-UBOOT_URL = 'git://git.denx.de/u-boot.git'
+UBOOT_URL = os.getenv('UBOOT_URL', 'git://git.denx.de/u-boot.git')
 LINUX_VER = "upstream/master"
 LINUX_TOOLS_VER = "github/rpi-4.9.y"
-LINUX_URL = "https://github.com/raspberrypi/linux"
-LINUX_UPSTREAM_URL = "git://git.kernel.org/pub/scm/linux/kernel/git/torvalds/linux.git"
-LINUX_STABLE_URL = "git://git.kernel.org/pub/scm/linux/kernel/git/stable/linux-stable.git"
+LINUX_URL = os.getenv('LINUX_URL', "https://github.com/raspberrypi/linux")
+LINUX_UPSTREAM_URL = os.getenv('LINUX_UPSTREAM_URL', "git://git.kernel.org/pub/scm/linux/kernel/git/torvalds/linux.git")
+LINUX_STABLE_URL = os.getenv('LINUX_STABLE_URL', "git://git.kernel.org/pub/scm/linux/kernel/git/stable/linux-stable.git")
+LINUX_REMOTES = [ ("github", LINUX_URL), ("upstream", LINUX_UPSTREAM_URL), ("stable", LINUX_STABLE_URL) ]
 FIRMWARE_VER = "github/master"
-FIRMWARE_URL = "http://github.com/raspberrypi/firmware"
+FIRMWARE_URL = os.getenv('FIRMWARE_URL', "http://github.com/raspberrypi/firmware")
+GIT_DEPTH = int(os.getenv('GIT_DEPTH', '0'))
+GIT_FILTER = os.getenv('GIT_FILTER', '')
+BUILDER_VERSION = "1"
+PACKAGE_CACHE = os.getenv('PACKAGE_CACHE', OPJ("repo", "cache"))
+CCACHE_DIR = os.getenv('CCACHE_DIR', OPJ("repo", "ccache"))
+LINUX_CONFIG = os.getenv('LINUX_CONFIG', "linux-config")
 
 class GlobalBuildContext:
     pass
@@ -38,14 +43,109 @@ class git_run(object):
     def run(self, s, repo, cmd):
         self.returncode = ib.subprocess(s, ["git", "-C", repo] + list(cmd)).returncode
 
+def is_sha(ref):
+    return re.match(r"^[0-9a-f]{40}$", ref) is not None
+
+def wanted_refs(remote, remotes, wants):
+    result = []
+    for ref in wants:
+        prefix = ref.split("/", 1)[0]
+        if prefix == remote or prefix not in remotes:
+            result.append(ref)
+    return result
+
+@ib.buildcmd()
+@ib.buildcmd_flatten()
+class has_commit(object):
+    def run(self, s, repo, ref):
+        # rev-list --missing=print doesn't trigger a lazy fetch from a promisor remote
+        self.present = git_run(s, repo, [ 'rev-list', '--no-walk', '--missing=print',
+            '%s^{commit}' % ref, '--' ]).returncode == 0
+
+@ib.buildcmd()
+@ib.buildcmd_flatten()
+class ls_remote(object):
+    def run(self, s, repo, remote, ref):
+        proc = subprocess.Popen(['git', '-C', repo, 'ls-remote', remote, ref], stdout=subprocess.PIPE)
+        out = proc.communicate()[0]
+        if proc.returncode != 0:
+            raise ib.BuilderError("Can't list %s on %s" % (ref, remote))
+        self.commit = None
+        for line in out.decode('utf-8').splitlines():
+            commit, name = line.split("\t", 1)
+            if name == ref:
+                self.commit = commit
+        if self.commit is None:
+            raise ib.BuilderError("%s doesn't exist on %s" % (ref, remote))
+
 @ib.buildcmd()
 class fetch_git_url(object):
-    def run(self, s, repo, remote, url):
+    def run(self, s, repo, remote, url, wants):
         if not os.path.isdir(repo):
-            ib.check_subprocess(s, ['git', 'clone', '--bare', url, repo])
+            ib.check_subprocess(s, ['git', 'init', '-q', '--bare', repo])
         if git_run(s, repo, [ 'remote', 'set-url', remote, url ]).returncode != 0:
             check_git_run(s, repo, [ 'remote', 'add', remote, url ])
-        check_git_run(s, repo, [ 'fetch', remote ])
+        if GIT_FILTER:
+            check_git_run(s, repo, [ 'config', 'remote.%s.promisor' % remote, 'true' ])
+            check_git_run(s, repo, [ 'config', 'remote.%s.partialclonefilter' % remote, GIT_FILTER ])
+
+        refspecs = []
+        for ref in wants:
+            if is_sha(ref):
+                if not has_commit(s, repo, ref).present:
+                    refspecs.append("+%s:refs/fetched/%s" % (ref, ref))
+            elif ref.startswith(remote + "/"):
+                branch = ref[len(remote) + 1:]
+                local = "refs/remotes/%s" % ref
+                commit = ls_remote(s, repo, remote, "refs/heads/%s" % branch).commit
+                if has_commit(s, repo, commit).present:
+                    check_git_run(s, repo, [ 'update-ref', local, commit ])
+                else:
+                    refspecs.append("+refs/heads/%s:%s" % (branch, local))
+            elif not has_commit(s, repo, "refs/tags/%s" % ref).present:
+                refspecs.append("+refs/tags/%s:refs/tags/%s" % (ref, ref))
+
+        if not refspecs:
+            s.info("Nothing to fetch from %s", remote)
+            return
+        cmd = [ 'fetch', '--no-tags', remote ]
+        if GIT_DEPTH > 0:
+            cmd.insert(1, '--depth=%d' % GIT_DEPTH)
+        if GIT_FILTER:
+            cmd.insert(1, '--filter=%s' % GIT_FILTER)
+        check_git_run(s, repo, cmd + refspecs)
+
+@ib.buildcmd()
+class fetch_git_remotes(object):
+    def run(self, s, repo, remotes, wants):
+        names = [ name for name, url in remotes ]
+        for name, url in remotes:
+            fetch_git_url(s, repo, name, url, wanted_refs(name, names, wants))
+
+@ib.buildcmd()
+@ib.buildcmd_flatten()
+class resolve_commit(object):
+    def run(self, s, repo, ref):
+        proc = subprocess.Popen(['git', '-C', repo, 'rev-parse', '--verify', '-q', '%s^{commit}' % ref],
+                stdout=subprocess.PIPE)
+        out = proc.communicate()[0]
+        if proc.returncode != 0:
+            raise ib.BuilderError("Can't resolve %s in %s" % (ref, repo))
+        self.commit = out.decode('utf-8').strip()
+        s.debug("Resolved %s to %s", ref, self.commit)
+
+# A branch on one of the given remotes is looked up there, as the local
+# remote-tracking ref is only as fresh as the last fetch
+@ib.buildcmd()
+@ib.buildcmd_flatten()
+class current_commit(object):
+    def run(self, s, repo, remotes, ref):
+        urls = dict(remotes)
+        remote = ref.split("/", 1)[0]
+        if remote in urls:
+            self.commit = ls_remote(s, repo, urls[remote], "refs/heads/%s" % ref[len(remote) + 1:]).commit
+        else:
+            self.commit = resolve_commit(s, repo, ref).commit
 
 @ib.buildcmd()
 class setup_gbc(object):
@@ -53,12 +153,11 @@ class setup_gbc(object):
         self.gbc = GlobalBuildContext()
         self.gbc.tmp = ib.mkdtemp(s, path=os.getcwd()).path
         self.gbc.repo = "repo"
-        self.gbc.in_sudo = False
-        self.gbc.in_fakeroot = False
         self.gbc.today = datetime.datetime.now().strftime("%Y%m%d%H%M")
 
         if not os.path.isdir(self.gbc.repo):
             os.mkdir(self.gbc.repo)
+        self.gbc.make_vars = ib.ccache.setup(s, CCACHE_DIR).vars
 
 @ib.buildcmd()
 class create_worktree(object):
@@ -80,326 +179,313 @@ class create_worktree(object):
 class setup_clone_linux(object):
     def run(self, s, gbc):
         gbc.linux_git = OPJ(gbc.repo, "linux.git")
-        fetch_git_url(s, gbc.linux_git, "github", LINUX_URL)
-        fetch_git_url(s, gbc.linux_git, "upstream", LINUX_UPSTREAM_URL)
-        fetch_git_url(s, gbc.linux_git, "stable", LINUX_STABLE_URL)
+        fetch_git_remotes(s, gbc.linux_git, LINUX_REMOTES, [ LINUX_VER, LINUX_TOOLS_VER ])
 
 @ib.buildcmd()
 @ib.buildcmd_once()
+@ib.buildcmd_depends(setup_clone_linux)
+class clone_linux(object):
+    def run(self, s, gbc):
+        setup_clone_linux(s, gbc)
+        gbc.linux = OPJ(gbc.repo, "linux")
+        create_worktree(s, gbc.linux_git, gbc.linux, LINUX_VER)
+
+@ib.buildcmd()
+@ib.buildcmd_once()
+@ib.buildcmd_depends(clone_linux)
 class clone_linux_tools(object):
     def run(self, s, gbc):
         setup_clone_linux(s, gbc)
         gbc.linux_tools = OPJ(gbc.repo, "linux-rpi-tools")
         create_worktree(s, gbc.linux_git, gbc.linux_tools, LINUX_TOOLS_VER)
 
-
 @ib.buildcmd()
 @ib.buildcmd_once()
-class clone_linux(object):
+class setup_clone_firmware(object):
     def run(self, s, gbc):
-        setup_clone_linux(s, gbc)
-        gbc.linux = OPJ(gbc.repo, "linux")
-        create_worktree(s, gbc.linux_git, gbc.linux, LINUX_VER)
+        gbc.firmware_git = OPJ(gbc.repo, "firmware.git")
+        fetch_git_url(s, gbc.firmware_git, "github", FIRMWARE_URL, [ FIRMWARE_VER ])
 
 @ib.buildcmd()
 @ib.buildcmd_once()
+@ib.buildcmd_depends(setup_clone_firmware)
 class clone_firmware(object):
     def run(self, s, gbc):
-        gbc.firmware_git = OPJ(gbc.repo, "firmware.git")
+        setup_clone_firmware(s, gbc)
         gbc.firmware = OPJ(gbc.repo, "firmware")
-        gbc.firmware_deb_d = OPJ(gbc.tmp, 'firmware-deb')
         gbc.firmware_deb = OPJ(gbc.tmp, "raspberrypi-firmware-git-{0}-1_armhf.deb".format(gbc.today))
-        fetch_git_url(s, gbc.firmware_git, "github", FIRMWARE_URL)
         create_worktree(s, gbc.firmware_git, gbc.firmware, FIRMWARE_VER)
 
 @ib.buildcmd()
 @ib.buildcmd_once()
-class clone_uboot(object):
+class setup_clone_uboot(object):
     def run(self, s, gbc):
         gbc.uboot_git = OPJ(gbc.repo, "u-boot.git")
+        fetch_git_url(s, gbc.uboot_git, "upstream", UBOOT_URL, [ UBOOT_VER ])
+
+@ib.buildcmd()
+@ib.buildcmd_once()
+@ib.buildcmd_depends(setup_clone_uboot)
+class clone_uboot(object):
+    def run(self, s, gbc):
+        setup_clone_uboot(s, gbc)
         gbc.uboot_pi2 = OPJ(gbc.repo, "u-boot-pi2")
         gbc.uboot_pi3 = OPJ(gbc.repo, "u-boot-pi3")
-        fetch_git_url(s, gbc.uboot_git, "upstream", UBOOT_URL)
         create_worktree(s, gbc.uboot_git, gbc.uboot_pi2, UBOOT_VER)
         create_worktree(s, gbc.uboot_git, gbc.uboot_pi3, UBOOT_VER)
 
+@ib.buildcmd()
+@ib.buildcmd_flatten()
+class linux_make(object):
+    def run(self, s, gbc, args, **kwargs):
+        ib.jobserver.make(s, [ '-C', gbc.linux, 'O=%s' % gbc.linux_build ] +
+                gbc.make_vars + list(args), **kwargs)
+
 @ib.buildcmd()
 @ib.buildcmd_once()
+@ib.buildcmd_depends(clone_linux)
 class pre_compile_linux(object):
     def run(self, s, gbc):
         clone_linux(s, gbc)
-        ib.check_subprocess(s, ['cp', 'linux-config', OPJ(gbc.linux, '.config')])
-        ib.check_subprocess(s, ['make', '-j4', '-C', gbc.linux, 'olddefconfig'], stdin=subprocess.DEVNULL)
+        name = os.path.basename(LINUX_CONFIG)
+        gbc.linux_build = os.path.abspath(OPJ(gbc.repo, "linux-build-%s" % name))
+        ib.file.mkdir(s, gbc.linux_build, exist_ok=True)
+        config = OPJ(gbc.linux_build, ".config")
+        stamp = OPJ(gbc.linux_build, ".config.stamp")
+        # a new kernel can bring new symbols, which Kbuild would otherwise
+        # prompt for on a captured stdin
+        wanted = ib.cache.key(ib.cache.hash_file(LINUX_CONFIG), resolve_commit(s, gbc.linux, "HEAD").commit)
+        current = None
+        if os.path.exists(config) and os.path.exists(stamp):
+            with open(stamp, "r") as f:
+                current = f.read().split()
+        if current == [ wanted, ib.cache.hash_file(config) ]:
+            s.info("%s unchanged, keeping %s", LINUX_CONFIG, config)
+        else:
+            shutil.copyfile(LINUX_CONFIG, config)
+            linux_make(s, gbc, [ 'olddefconfig' ], stdin=subprocess.DEVNULL)
+            with open(stamp, "w") as f:
+                f.write("%s %s\n" % (wanted, ib.cache.hash_file(config)))
+
+MAINTAINER = "Andrew Ruder <andy@aeruder.net>"
+
+def deb_control(package, version, description):
+    return {
+        "Package": package,
+        "Version": version,
+        "Section": "kernel",
+        "Priority": "optional",
+        "Architecture": "armhf",
+        "Maintainer": MAINTAINER,
+        "Description": description,
+    }
 
 @ib.buildcmd()
 @ib.buildcmd_once()
-class create_linux_deb(object):
+@ib.buildcmd_depends(pre_compile_linux)
+class create_linux_dtb_deb(object):
     def run(self, s, gbc):
         pre_compile_linux(s, gbc)
-        ib.check_subprocess(s, ['make', '-j4', '-C', gbc.linux, 'bindeb-pkg'])
-
-@ib.buildcmd()
-class create_linux_dtb_deb_fakeroot(object):
-    def run(self, s, gbc):
-        deb_d = OPJ(gbc.tmp, "linux-dtb-deb")
-        install_path = OPJ(deb_d, "boot", "firmware")
-        ib.file.install_dir(s, deb_d, 0, 0, 0o755)
-        ib.file.install_dir(s, OPJ(deb_d, "boot"), 0, 0, 0o755)
-        ib.file.install_dir(s, OPJ(deb_d, "boot", "firmware"), 0, 0, 0o755)
-        ib.check_subprocess(s, ['make', '-C', gbc.linux, 'INSTALL_DTBS_PATH=%s' % install_path, 'dtbs_install'])
-        ib.file.install_dir(s, OPJ(deb_d, "DEBIAN"), 0, 0, 0o755)
-        with open(OPJ(deb_d, "DEBIAN", "control"), "w") as f:
-            print(textwrap.dedent("""\
-                    Package: linux-dtb
-                    Version: {0}-1
-                    Section: kernel
-                    Priority: optional
-                    Architecture: armhf
-                    Maintainer: Andrew Ruder <andy@aeruder.net>
-                    Description: DTB files for Raspberry PI
-                      This is a debian package generated from the linux git repository""").format(gbc.linux_version),
-                    file=f)
-        ib.file.chmod(s, OPJ(deb_d, "DEBIAN", "control"), 0o644)
-        ib.check_subprocess(s, [ "dpkg-deb", "-b", deb_d, OPJ(gbc.tmp, "linux-dtb-%s-1_armhf.deb" % gbc.linux_version)])
-
-
+        linux_make(s, gbc, [ 'dtbs' ])
+        version = subprocess.Popen(['make', '-s', '-C', gbc.linux, 'O=%s' % gbc.linux_build, 'kernelrelease'],
+                stdout=subprocess.PIPE).communicate()[0]
+        version = version.decode('utf-8').split()[0]
+        gbc.linux_version = version
+        install_path = OPJ(gbc.tmp, "linux-dtb")
+        linux_make(s, gbc, [ 'INSTALL_DTBS_PATH=%s' % os.path.abspath(install_path), 'dtbs_install' ])
+        ib.deb.build(s, OPJ(gbc.tmp, "linux-dtb-%s-1_armhf.deb" % version),
+                deb_control("linux-dtb", "%s-1" % version, "DTB files for Raspberry PI\n"
+                    "This is a debian package generated from the linux git repository"),
+                ib.deb.tree(install_path, "/boot/firmware"))
+
+# Kbuild can't run two makes in one O= directory, and bindeb-pkg rewrites
+# what dtbs_install and kernelrelease read, so the kernel waits for the dtbs
 @ib.buildcmd()
 @ib.buildcmd_once()
-class create_linux_dtb_deb(object):
+@ib.buildcmd_depends(create_linux_dtb_deb)
+class create_linux_deb(object):
     def run(self, s, gbc):
         pre_compile_linux(s, gbc)
-        ib.check_subprocess(s, ['make', '-C', gbc.linux, '-j4', 'dtbs'])
-        version = subprocess.Popen(['make', '-s', '-C', gbc.linux, 'kernelrelease'], stdout=subprocess.PIPE).communicate()[0]
-        version = version.decode('utf-8').split()[0]
-        gbc.linux_version = version
-        run_with_fakeroot(s, gbc, create_linux_dtb_deb_fakeroot)
+        linux_make(s, gbc, [ 'bindeb-pkg' ])
 
 @ib.buildcmd()
 @ib.buildcmd_once()
+@ib.buildcmd_depends(clone_uboot)
 class compile_uboot_pi2(object):
     def run(self, s, gbc):
         clone_uboot(s, gbc)
-        ib.check_subprocess(s, ['make', '-C', gbc.uboot_pi2, "rpi_2_defconfig"])
-        ib.check_subprocess(s, ['make', '-j4', '-C', gbc.uboot_pi2])
+        ib.jobserver.make(s, [ '-C', gbc.uboot_pi2 ] + gbc.make_vars + [ "rpi_2_defconfig" ])
+        ib.jobserver.make(s, [ '-C', gbc.uboot_pi2 ] + gbc.make_vars)
 
 @ib.buildcmd()
 @ib.buildcmd_once()
+@ib.buildcmd_depends(clone_uboot)
 class compile_uboot_pi3(object):
     def run(self, s, gbc):
         clone_uboot(s, gbc)
-        ib.check_subprocess(s, ['make', '-C', gbc.uboot_pi3, "rpi_3_32b_defconfig"])
-        ib.check_subprocess(s, ['make', '-j4', '-C', gbc.uboot_pi3])
+        ib.jobserver.make(s, [ '-C', gbc.uboot_pi3 ] + gbc.make_vars + [ "rpi_3_32b_defconfig" ])
+        ib.jobserver.make(s, [ '-C', gbc.uboot_pi3 ] + gbc.make_vars)
 
 @ib.buildcmd()
 class create_uboot_deb_helper(object):
-    def run(self, s, gbc, build_d, deb_d, pkg, target):
-        ib.file.install_dir(s, deb_d, 0, 0, 0o755)
-        ib.file.install_dir(s, OPJ(deb_d, "boot"), 0, 0, 0o755)
-        ib.file.install_dir(s, OPJ(deb_d, "boot", "firmware"), 0, 0, 0o755)
-        ib.file.install_dir(s, OPJ(deb_d, "etc"), 0, 0, 0o755)
-        ib.file.install_dir(s, OPJ(deb_d, "etc", "kernel"), 0, 0, 0o755)
-        ib.file.install_dir(s, OPJ(deb_d, "etc", "kernel", "postinst.d"), 0, 0, 0o755)
-        ib.file.install(s, OPJ("u-boot-deb", "zz-u-boot"),
-                OPJ(deb_d, "etc", "kernel", "postinst.d", "zz-u-boot"), 0, 0, 0o755)
-        ib.file.install(s, OPJ("u-boot-deb", "config.txt"),
-                OPJ(deb_d, "boot", "firmware", "config.txt"), 0, 0, 0o644)
-        ib.file.install(s, OPJ("u-boot-deb", "cmdline.txt"),
-                OPJ(deb_d, "boot", "firmware", "cmdline.txt"), 0, 0, 0o644)
-        ib.file.install_dir(s, OPJ(deb_d, "DEBIAN"), 0, 0, 0o755)
-        with open(OPJ(deb_d, "DEBIAN", "conffiles"), "w") as f:
-            print(textwrap.dedent("""\
-                    /boot/firmware/cmdline.txt
-                    /boot/firmware/config.txt
-                    /boot/firmware/uboot.env"""), file=f)
-        ib.file.chmod(s, OPJ(deb_d, "DEBIAN", "conffiles"), 0o644)
-        with open(OPJ(deb_d, "DEBIAN", "control"), "w") as f:
-            print(textwrap.dedent("""\
-                    Package: {2}
-                    Version: {0}-1
-                    Section: kernel
-                    Priority: optional
-                    Architecture: armhf
-                    Maintainer: Andrew Ruder <andy@aeruder.net>
-                    Description: U-Boot for raspberry {1}
-                      This is a debian package generated from the u-boot git repository""").format(gbc.today, target, pkg),
-                    file=f)
-        ib.file.chmod(s, OPJ(deb_d, "DEBIAN", "control"), 0o644)
-        with open("u-boot-env.txt", "r") as fin:
-            with open(OPJ(gbc.tmp, "u-boot-env-stripped.txt"), "wb") as fout:
-                ib.check_subprocess(s, [ 'bash', OPJ("utils", "env_filter.sh") ],
-                        stdin=fin, stdout=fout)
-        ib.check_subprocess(s, [ OPJ(build_d, "tools", "mkenvimage"), "-p", "0",
-            "-s", "16384", "-o", OPJ(deb_d, "boot", "firmware", "uboot.env"),
-            OPJ(gbc.tmp, "u-boot-env-stripped.txt") ])
-        ib.file.chmod(s, OPJ(deb_d, "boot", "firmware", "uboot.env"), 0o644)
-
+    def run(self, s, gbc, build_d, pkg, target):
+        work_d = OPJ(gbc.tmp, pkg)
+        ib.file.mkdir(s, work_d)
+        ib.ubootenv.image(s, "u-boot-env.txt", OPJ(work_d, "uboot.env"), 16384)
         ib.check_subprocess(s, [ OPJ(gbc.linux_tools, "scripts", "mkknlimg"), "--dtok", "--283x",
-            OPJ(build_d, "u-boot.bin"), OPJ(deb_d, "boot", "firmware", "uboot.bin") ])
-        ib.file.chmod(s, OPJ(deb_d, "boot", "firmware", "uboot.bin"), 0o644)
-
-        ib.check_subprocess(s, [ "dpkg-deb", "-b", deb_d, OPJ(gbc.tmp, "%s-%s-1_armhf.deb" % (pkg, gbc.today))])
-
-@ib.buildcmd()
-class create_uboot_pi2_deb_helper(object):
-    def run(self, s, gbc):
-        create_uboot_deb_helper(s, gbc, gbc.uboot_pi2, OPJ(gbc.tmp, "uboot-pi2-deb"), "u-boot-pi2-git", "pi2")
-
-@ib.buildcmd()
-class create_uboot_pi3_deb_helper(object):
-    def run(self, s, gbc):
-        create_uboot_deb_helper(s, gbc, gbc.uboot_pi3, OPJ(gbc.tmp, "uboot-pi3-deb"), "u-boot-pi3-git", "pi3")
+            OPJ(build_d, "u-boot.bin"), OPJ(work_d, "uboot.bin") ])
+
+        ib.deb.build(s, OPJ(gbc.tmp, "%s-%s-1_armhf.deb" % (pkg, gbc.today)),
+                deb_control(pkg, "%s-1" % gbc.today, "U-Boot for raspberry %s\n"
+                    "This is a debian package generated from the u-boot git repository" % target),
+                [ (OPJ("u-boot-deb", "zz-u-boot"), "/etc/kernel/postinst.d/zz-u-boot", 0, 0, 0o755),
+                  (OPJ("u-boot-deb", "config.txt"), "/boot/firmware/config.txt", 0, 0, 0o644),
+                  (OPJ("u-boot-deb", "cmdline.txt"), "/boot/firmware/cmdline.txt", 0, 0, 0o644),
+                  (OPJ(work_d, "uboot.env"), "/boot/firmware/uboot.env", 0, 0, 0o644),
+                  (OPJ(work_d, "uboot.bin"), "/boot/firmware/uboot.bin", 0, 0, 0o644) ],
+                conffiles=[ "/boot/firmware/cmdline.txt",
+                            "/boot/firmware/config.txt",
+                            "/boot/firmware/uboot.env" ])
 
 @ib.buildcmd()
 @ib.buildcmd_once()
+@ib.buildcmd_depends(clone_linux_tools, compile_uboot_pi2)
 class create_uboot_pi2_deb(object):
     def run(self, s, gbc):
         clone_linux_tools(s, gbc)
         compile_uboot_pi2(s, gbc)
-        run_with_fakeroot(s, gbc, create_uboot_pi2_deb_helper)
+        create_uboot_deb_helper(s, gbc, gbc.uboot_pi2, "u-boot-pi2-git", "pi2")
 
 @ib.buildcmd()
 @ib.buildcmd_once()
+@ib.buildcmd_depends(clone_linux_tools, compile_uboot_pi3)
 class create_uboot_pi3_deb(object):
     def run(self, s, gbc):
         clone_linux_tools(s, gbc)
         compile_uboot_pi3(s, gbc)
-        run_with_fakeroot(s, gbc, create_uboot_pi3_deb_helper)
-
-@ib.buildcmd()
-class create_firmware_deb_helper(object):
-    def run(self, s, gbc):
-        ib.file.install_dir(s, gbc.firmware_deb_d, 0, 0, 0o755)
-        ib.file.install_dir(s, OPJ(gbc.firmware_deb_d, "boot"), 0, 0, 0o755)
-        ib.file.copy_r(s, OPJ(gbc.firmware, "boot"),
-                OPJ(gbc.firmware_deb_d, "boot", "firmware"))
-        ib.file.rm(s, OPJ(gbc.firmware_deb_d, "boot", "firmware", "kernel.img"))
-        ib.file.rm(s, OPJ(gbc.firmware_deb_d, "boot", "firmware", "kernel7.img"))
-        ib.check_subprocess(s, [ 'chmod', '-R', 'u=rwX,g=rX,o=rX',
-            OPJ(gbc.firmware_deb_d, "boot", "firmware") ])
-
-        ib.file.install_dir(s, OPJ(gbc.firmware_deb_d, "DEBIAN"), 0, 0, 0o755)
-        with open(OPJ(gbc.firmware_deb_d, "DEBIAN", "control"), "w") as f:
-            print(textwrap.dedent("""\
-                    Package: raspberrypi-firmware-git
-                    Version: {0}-1
-                    Section: kernel
-                    Priority: optional
-                    Architecture: armhf
-                    Maintainer: Andrew Ruder <andy@aeruder.net>
-                    Description: Raspberry-pi firmware
-                      This is a debian package generated from the raspberrypi firmware git repository""").format(gbc.today),
-                    file=f)
-        ib.file.chmod(s, OPJ(gbc.firmware_deb_d, "DEBIAN", "control"), 0o644)
-        ib.check_subprocess(s, [ "dpkg-deb", "-b", gbc.firmware_deb_d, gbc.firmware_deb ])
+        create_uboot_deb_helper(s, gbc, gbc.uboot_pi3, "u-boot-pi3-git", "pi3")
 
 @ib.buildcmd()
 @ib.buildcmd_once()
+@ib.buildcmd_depends(clone_firmware)
 class create_firmware_deb(object):
     def run(self, s, gbc):
         clone_firmware(s, gbc)
-        run_with_fakeroot(s, gbc, create_firmware_deb_helper)
-
-@ib.buildcmd()
-class run_with_root(object):
-    def run(self, s, gbc, command, sudo=False, fakeroot=False):
-        launch_sub = False
-        out_file = None
-        sub_type = None
-        if sudo:
-            if gbc.in_sudo:
-                command(s, gbc)
-            else:
-                out_file = OPJ(gbc.tmp, "gbc_sudo")
-                launch_sub = True
-                sub_type = "sudo"
-        elif fakeroot:
-            if gbc.in_fakeroot:
-                command(s, gbc)
-            else:
-                out_file = OPJ(gbc.tmp, "gbc_fakeroot")
-                launch_sub = True
-                sub_type = "fakeroot"
-        else:
-            command(s, gbc)
-        if launch_sub:
-            with open(out_file, "wb") as f:
-                pickle.dump(gbc, f, protocol=pickle.HIGHEST_PROTOCOL)
-            ib.check_subprocess(s, [ sub_type, sys.argv[0], "resume", sub_type, out_file, command.__name__ ])
-            with open(out_file, "rb") as f:
-                gbc = pickle.load(f)
+        ib.deb.build(s, gbc.firmware_deb,
+                deb_control("raspberrypi-firmware-git", "%s-1" % gbc.today, "Raspberry-pi firmware\n"
+                    "This is a debian package generated from the raspberrypi firmware git repository"),
+                ib.deb.tree(OPJ(gbc.firmware, "boot"), "/boot/firmware",
+                    exclude=[ "kernel.img", "kernel7.img" ]))
 
 @ib.buildcmd()
-@ib.buildcmd_flatten()
-class run_with_sudo(object):
-    def run(self, s, gbc, command):
-        run_with_root(s, gbc, command, sudo=True)
+class package_keys(object):
+    def run(self, s, gbc, fetch=False):
+        linux_git = OPJ(gbc.repo, "linux.git")
+        uboot_git = OPJ(gbc.repo, "u-boot.git")
+        firmware_git = OPJ(gbc.repo, "firmware.git")
+        wants = [ ("linux", linux_git, LINUX_REMOTES, LINUX_VER),
+                  ("linux tools", linux_git, LINUX_REMOTES, LINUX_TOOLS_VER),
+                  ("u-boot", uboot_git, [ ("upstream", UBOOT_URL) ], UBOOT_VER),
+                  ("firmware", firmware_git, [ ("github", FIRMWARE_URL) ], FIRMWARE_VER) ]
+        # branches are asked of the remote, which downloads nothing; anything
+        # else has to be here already or it's time to fetch
+        if not fetch:
+            fetch = not all(os.path.isdir(repo) and (ref.split("/", 1)[0] in dict(remotes) or
+                    has_commit(s, repo, ref).present) for name, repo, remotes, ref in wants)
+        if fetch:
+            ib.scheduler.run(s, [ setup_clone_linux, setup_clone_uboot, setup_clone_firmware ], gbc)
+        self.fetched = fetch
+        commits = {}
+        for name, repo, remotes, ref in wants:
+            # straight after a fetch the local refs are current
+            commits[name] = current_commit(s, repo, [] if fetch else remotes, ref).commit
+            s.info("Keying %s on %s (%s)", name, commits[name][:12], ref)
+        linux, linux_tools = commits["linux"], commits["linux tools"]
+        uboot, firmware = commits["u-boot"], commits["firmware"]
+        linux_config = ib.cache.hash_file(LINUX_CONFIG)
+        uboot_files = ib.cache.hash_files(glob.glob(OPJ("u-boot-deb", "*")) +
+                [ "u-boot-env.txt", OPJ("image_builder", "ubootenv.py") ])
+
+        self.keys = {
+            "linux-dtb": ib.cache.key(BUILDER_VERSION, "linux-dtb", linux, linux_config),
+            "u-boot-pi2-git": ib.cache.key(BUILDER_VERSION, "u-boot-pi2-git", uboot, linux_tools, uboot_files),
+            "u-boot-pi3-git": ib.cache.key(BUILDER_VERSION, "u-boot-pi3-git", uboot, linux_tools, uboot_files),
+            "raspberrypi-firmware-git": ib.cache.key(BUILDER_VERSION, "raspberrypi-firmware-git", firmware),
+            "linux": ib.cache.key(BUILDER_VERSION, "linux", linux, linux_config),
+        }
 
 @ib.buildcmd()
 @ib.buildcmd_flatten()
-class run_with_fakeroot(object):
-    def run(self, s, gbc, command):
-        run_with_root(s, gbc, command, fakeroot=True)
+class restore_package(object):
+    def run(self, s, gbc, name, patterns):
+        cached = ib.cache.lookup(s, PACKAGE_CACHE, name, gbc.keys[name]).files
+        self.hit = cached is not None
+        if not self.hit:
+            return
+        names = [ os.path.basename(a) for a in cached ]
+        for p in patterns:
+            for a in glob.glob(OPJ('packages', p)):
+                if os.path.basename(a) not in names:
+                    ib.file.rm(s, a)
+        ib.cache.restore(s, PACKAGE_CACHE, name, gbc.keys[name], 'packages')
 
 @ib.buildcmd()
-class resume(object):
-    def run(self, s):
-        self.resumed = False
-        if len(sys.argv) == 5 and sys.argv[1] == "resume":
-            if sys.argv[2] == "sudo":
-                with open(sys.argv[3], "rb") as f:
-                    gbc = pickle.load(f)
-                gbc.in_sudo = True
-                run_with_sudo(s, gbc, globals()[sys.argv[4]])
-                gbc.in_sudo = False
-                with open(sys.argv[3], "wb") as f:
-                    pickle.dump(gbc, f, protocol=pickle.HIGHEST_PROTOCOL)
-            elif sys.argv[2] == "fakeroot":
-                with open(sys.argv[3], "rb") as f:
-                    gbc = pickle.load(f)
-                gbc.in_fakeroot = True
-                run_with_fakeroot(s, gbc, globals()[sys.argv[4]])
-                gbc.in_fakeroot = False
-                with open(sys.argv[3], "wb") as f:
-                    pickle.dump(gbc, f, protocol=pickle.HIGHEST_PROTOCOL)
-            self.resumed = True
+class store_package(object):
+    def run(self, s, gbc, name, patterns):
+        files = []
+        for d in [ gbc.tmp, gbc.repo ]:
+            for p in patterns:
+                files.extend(glob.glob(OPJ(d, p)))
+        if len(files) == 0:
+            raise ib.BuilderError("No packages built for %s" % name)
+        ib.cache.store(s, PACKAGE_CACHE, name, gbc.keys[name], files)
+        restore_package(s, gbc, name, patterns)
+
+PACKAGES = [
+    ("linux-dtb", create_linux_dtb_deb, [ 'linux-dtb-*.deb' ]),
+    ("u-boot-pi2-git", create_uboot_pi2_deb, [ 'u-boot-pi2-git-*.deb' ]),
+    ("u-boot-pi3-git", create_uboot_pi3_deb, [ 'u-boot-pi3-git-*.deb' ]),
+    ("raspberrypi-firmware-git", create_firmware_deb, [ 'raspberrypi-firmware-git-*.deb' ]),
+    ("linux", create_linux_deb, [ 'linux-firmware-image-*.deb', 'linux-image-*.deb',
+                                  'linux-libc-dev*.deb', 'linux-headers-*.deb' ]),
+]
 
 @ib.buildcmd()
-class move_packages(object):
+class restore_packages(object):
     def run(self, s, gbc):
-        for a in glob.glob(OPJ(gbc.tmp, '*.deb')):
-            ib.file.copy(s, a, 'packages')
-        if hasattr(gbc, "linux"):
-            for a in glob.glob(OPJ(gbc.linux, "..", "linux-*.deb")):
-                ib.file.copy(s, a, "packages")
+        self.targets = []
+        for name, command, patterns in PACKAGES:
+            if restore_package(s, gbc, name, patterns).hit:
+                s.info("Using cached %s", name)
+            else:
+                self.targets.append(command)
 
-with ib.builder() as s:
-    if not resume(s).resumed:
-        gbc = setup_gbc(s).gbc
-
-        try:
-            if len(glob.glob(OPJ('packages', 'linux-dtb-*.deb'))) == 0:
-                create_linux_dtb_deb(s, gbc)
-            if len(glob.glob(OPJ('packages', 'u-boot-pi2-git-*.deb'))) == 0:
-                create_uboot_pi2_deb(s, gbc)
-            if len(glob.glob(OPJ('packages', 'u-boot-pi3-git-*.deb'))) == 0:
-                create_uboot_pi3_deb(s, gbc)
-            if len(glob.glob(OPJ('packages', 'raspberrypi-firmware-git-*.deb'))) == 0:
-                create_firmware_deb(s, gbc)
-            if (len(glob.glob(OPJ('packages', 'linux-firmware-image-*.deb'))) == 0 or
-                len(glob.glob(OPJ('packages', 'linux-image-*.deb'))) == 0 or
-                len(glob.glob(OPJ('packages', 'linux-libc-dev*.deb'))) == 0 or
-                len(glob.glob(OPJ('packages', 'linux-headers-*.deb'))) == 0):
-                for a in glob.glob(OPJ('packages', 'linux-firmware-image-*.deb')):
-                    ib.file.rm(s, a)
-                for a in glob.glob(OPJ('packages', 'linux-image-*.deb')):
-                    ib.file.rm(s, a)
-                for a in glob.glob(OPJ('packages', 'linux-libc-dev*.deb')):
-                    ib.file.rm(s, a)
-                for a in glob.glob(OPJ('packages', 'linux-headers-*.deb')):
-                    ib.file.rm(s, a)
-                create_linux_deb(s, gbc)
+def usage():
+    print("Usage: %s [--update]" % sys.argv[0])
+    print("")
+    print("Packages are keyed on the commits their sources resolve to, with branches looked")
+    print("up on the remote. Nothing is fetched while every package is cached; --update")
+    print("fetches all sources regardless.")
+    sys.exit(1)
 
-            move_packages(s, gbc)
-        finally:
-            if os.getenv('INTERACTIVE', '0') == '1':
-                ib.subprocess(s, [ 'bash' ])
+with ib.builder() as s:
+    if [ a for a in sys.argv[1:] if a != "--update" ]:
+        usage()
+    gbc = setup_gbc(s).gbc
+
+    try:
+        keys = package_keys(s, gbc, "--update" in sys.argv[1:])
+        gbc.keys = keys.keys
+        targets = restore_packages(s, gbc).targets
+        if targets and not keys.fetched:
+            # something has to be built anyway, so build it from fresh refs
+            gbc.keys = package_keys(s, gbc, True).keys
+            targets = restore_packages(s, gbc).targets
+        ib.scheduler.run(s, targets, gbc)
+        for name, command, patterns in PACKAGES:
+            if command in targets:
+                store_package(s, gbc, name, patterns)
+        ib.aptrepo.index(s, 'packages')
+    finally:
+        if os.getenv('INTERACTIVE', '0') == '1':
+            ib.subprocess(s, [ 'bash' ], passthrough=True)
@@ -3,17 +3,31 @@
 import image_builder as ib
 import os
 import sys
-import pickle
 import subprocess
 import textwrap
 import datetime
-import shutil
 import glob
+import copy
 
 OPJ = os.path.join
 
 DEBIAN_VER = "stretch"
-MIRROR = "http://ftp.us.debian.org/debian/"
+MIRROR = os.getenv('MIRROR', "http://ftp.us.debian.org/debian/")
+IMAGE_SIZE = 800*1024*1024
+IMAGE_COMPRESSION = os.getenv('IMAGE_COMPRESSION', 'gz')
+IMAGE_ASSEMBLY = os.getenv('IMAGE_ASSEMBLY', 'mount')
+PREVIOUS_IMAGE = os.getenv('PREVIOUS_IMAGE', '')
+PARTITIONS = [ ("firmware", 2048, 49152, "e"),
+               ("boot", 51200, 153600, "83"),
+               ("root", 204800, None, "83") ]
+ROOTFS_CACHE = os.getenv('ROOTFS_CACHE', OPJ("repo", "rootfs-cache"))
+APT_CACHE = os.getenv('APT_CACHE', OPJ("repo", "apt-archives"))
+LOCAL_REPO = "/mnt/packages"
+APT_CACHE_SIZE = int(os.getenv('APT_CACHE_SIZE', '%d' % (2*1024*1024*1024)))
+BOARDS = [ "pi2", "pi3" ]
+OVERLAY_RULES = os.getenv('OVERLAY_RULES', "overlay.rules")
+BASE_PACKAGES = [ 'openssh-client', 'openssh-server', 'initramfs-tools', 'btrfs-tools',
+                  'parted', 'wpasupplicant' ]
 
 class GlobalBuildContext:
     pass
@@ -29,13 +43,16 @@ class setup_gbc(object):
         if not os.path.isdir(self.gbc.repo):
             os.mkdir(self.gbc.repo)
 
+def base_tarball(gbc):
+    debiantar = None
+    for a in sorted(glob.glob(OPJ(gbc.repo, "{0}-bare-*.tar.gz".format(DEBIAN_VER)))):
+        debiantar = a
+    return debiantar
+
 @ib.buildcmd()
 class download_repo(object):
     def run(self, s, gbc):
-        gbc.debian = gbc.mnt
-        debiantar = None
-        for a in glob.glob(OPJ(gbc.repo, "{0}-bare-*.tar.gz".format(DEBIAN_VER))):
-            debiantar = a
+        debiantar = base_tarball(gbc)
         if debiantar != None:
             s.info("Found %s, skipping debootstrap" % debiantar)
             with open(debiantar, "rb") as f:
@@ -77,46 +94,81 @@ class apt_get(object):
 
 @ib.buildcmd()
 @ib.buildcmd_flatten()
-class install_deb(object):
-    def run(self, s, root, pkg):
-        ib.file.copyfile(s, pkg, OPJ(root, "install.deb"))
-        run_chroot(s, root, [ 'dpkg', '-i', '/install.deb' ])
-        ib.file.rm(s, OPJ(root, "install.deb"))
+class chroot_bind(object):
+    def run(self, s, root, src, path, readonly=False):
+        self.created = []
+        target = root + path
+        d = target
+        while not os.path.isdir(d):
+            self.created.insert(0, d)
+            d = os.path.dirname(d)
+        for d in self.created:
+            ib.file.mkdir(s, d)
+        ib.bind_mount(s, src, target, readonly)
+
+    def cleanup(self, s):
+        for d in reversed(self.created):
+            os.rmdir(d)
 
 @ib.buildcmd()
-@ib.buildcmd_flatten()
-class overlay(object):
-    def run(self, s, root, path, uid, gid, perm):
-        from_path = "overlay" + path
-        to_path = root + path
-        ib.file.install(s, from_path, to_path, uid, gid, perm)
+class apt_archive_cache(object):
+    def run(self, s, gbc):
+        if not os.path.isdir(OPJ(APT_CACHE, "partial")):
+            os.makedirs(OPJ(APT_CACHE, "partial"))
+        chroot_bind(s, gbc.debian, os.path.abspath(APT_CACHE), "/var/cache/apt/archives")
+        if MIRROR.startswith("file://"):
+            mirror = MIRROR[len("file://"):]
+            chroot_bind(s, gbc.debian, mirror, mirror, readonly=True)
+
+def fs_type(path):
+    proc = subprocess.Popen([ 'stat', '-f', '-c', '%T', path ], stdout=subprocess.PIPE)
+    return proc.communicate()[0].decode('utf-8').strip()
 
 @ib.buildcmd()
-@ib.buildcmd_flatten()
-class soverlay(object):
-    def run(self, s, gbc, root, path, uid, gid, perm):
-        from_path = "overlay" + path + "." + gbc.build
-        to_path = root + path
-        ib.file.install(s, from_path, to_path, uid, gid, perm)
+class stage_tree(object):
+    def run(self, s, path, source=None):
+        self.path = path
+        self.subvolume = fs_type(os.path.dirname(os.path.abspath(path))) == "btrfs"
+        if source is not None:
+            self.subvolume = self.subvolume and ib.subprocess(s, [ 'btrfs', 'subvolume', 'show', source ]).returncode == 0
+        ib.journal.acquire(self, "subvolume" if self.subvolume else "tree", os.path.realpath(path))
+        if source is not None:
+            if self.subvolume:
+                ib.check_subprocess(s, [ 'btrfs', 'subvolume', 'snapshot', source, path ])
+            else:
+                ib.file.sync_tree(s, source, path)
+        elif self.subvolume:
+            ib.check_subprocess(s, [ 'btrfs', 'subvolume', 'create', path ])
+        else:
+            ib.file.mkdir(s, path)
+
+    def cleanup(self, s):
+        if self.subvolume:
+            ib.check_subprocess(s, [ 'btrfs', 'subvolume', 'delete', self.path ])
+        else:
+            ib.journal.remove_tree(s, self.path)
+        ib.journal.release(self)
+
+@ib.buildcmd()
+class copy_rootfs(object):
+    def run(self, s, src, dest):
+        # boot is its own ext4 filesystem, leave its lost+found alone
+        ib.file.sync_tree(s, src, dest, exclude=[ "boot/firmware", "boot/lost+found" ])
+        if os.path.isdir(OPJ(src, "boot", "firmware")):
+            ib.file.sync_tree(s, OPJ(src, "boot", "firmware"), OPJ(dest, "boot", "firmware"), metadata=False)
 
 @ib.buildcmd()
 class create_image(object):
     def run(self, s, gbc):
         gbc.img = OPJ(gbc.tmp, "img.bin")
-        ib.check_subprocess(s, [ 'dd', 'if=/dev/zero', 'of=%s' % gbc.img, 'bs=1048576', 'count=800' ])
+        ib.empty_image(s, gbc.img, IMAGE_SIZE)
         gbc.dev = ib.loopback.init(s, gbc.img, partscan=True).device
 
 @ib.buildcmd()
 class create_partitions(object):
     def run(self, s, gbc):
         with open(OPJ(gbc.tmp, "sfdisk.scr"), "w") as f:
-            print(textwrap.dedent("""\
-                label: dos
-                unit: sectors
-
-                start=2048, size=49152, type=e
-                start=51200, size=153600, type=83
-                start=204800, type=83"""), file=f)
+            f.write(ib.assemble.sfdisk_script(PARTITIONS))
         with open(OPJ(gbc.tmp, "sfdisk.scr"), "r") as f:
             ib.check_subprocess(s, [ 'sfdisk', gbc.dev ], stdin=f)
         gbc.fwdev = gbc.dev + "p1"
@@ -133,7 +185,7 @@ class format_partitions(object):
 @ib.buildcmd()
 class mount_partitions(object):
     def run(self, s, gbc):
-        gbc.mnt = OPJ(gbc.tmp, DEBIAN_VER)
+        gbc.mnt = OPJ(gbc.tmp, "mnt")
         ib.file.mkdir(s, gbc.mnt)
         with ib.builder() as s1:
             ib.mount(s1, 'btrfs', gbc.rootdev, gbc.mnt, "rw,relatime,compress=lzo,space_cache")
@@ -147,22 +199,182 @@ class mount_partitions(object):
         ib.file.mkdir(s, OPJ(gbc.mnt, "boot", "firmware"))
         ib.mount(s, 'vfat', gbc.fwdev, OPJ(gbc.mnt, 'boot', 'firmware'))
 
+@ib.buildcmd()
+class assemble_partition(object):
+    def run(self, s, name, gbc):
+        offset, size = ib.assemble.partition_bytes(PARTITIONS, IMAGE_SIZE)[name]
+        output = OPJ(gbc.tmp, "%s.img" % name)
+        layout = OPJ(gbc.tmp, "layout-%s" % name)
+        if name == "firmware":
+            ib.assemble.vfat(s, OPJ(gbc.debian, "boot", "firmware"), output, size)
+        elif name == "boot":
+            ib.assemble.link_tree(s, OPJ(gbc.debian, "boot"), layout, exclude=[ "firmware" ])
+            ib.assemble.ext4(s, layout, output, size)
+        else:
+            ib.file.mkdir(s, layout)
+            ib.assemble.link_tree(s, gbc.debian, OPJ(layout, "rootfs"), exclude=[ "boot", "home" ])
+            ib.assemble.link_tree(s, OPJ(gbc.debian, "home"), OPJ(layout, "home"))
+            ib.assemble.btrfs(s, layout, output, size, subvolumes=[ "rootfs", "home" ])
+        self.output = output
+
+@ib.buildcmd()
+class assemble_image(object):
+    def run(self, s, gbc):
+        gbc.img = OPJ(gbc.tmp, "img.bin")
+        names = [ p[0] for p in PARTITIONS ]
+        ib.scheduler.each(s, assemble_partition, names, gbc, jobs=len(names))
+        images = { name: OPJ(gbc.tmp, "%s.img" % name) for name in names }
+        ib.assemble.stitch(s, gbc.img, IMAGE_SIZE, PARTITIONS, images)
+        for path in images.values():
+            ib.file.rm(s, path)
+
+def common_package_files():
+    return (glob.glob(OPJ("packages", "raspberrypi-firmware-git-*.deb")) +
+            glob.glob(OPJ("packages", "linux-*.deb")))
+
+def board_package_files(build):
+    return glob.glob(OPJ("packages", "u-boot-%s-git-*.deb" % build))
+
 @ib.buildcmd()
 class install_packages(object):
+    def run(self, s, gbc, package_files, archive_cache=True):
+        ib.aptrepo.refresh(s, "packages")
+        files = [ os.path.basename(a) for a in package_files ]
+        indexed = { os.path.basename(p["Filename"]): p for p in ib.aptrepo.packages("packages") }
+        missing = [ a for a in files if a not in indexed ]
+        if missing:
+            raise ib.BuilderError("Not in the packages index: %s" % ", ".join(missing))
+        wanted = [ "%s=%s" % (indexed[a]["Package"], indexed[a]["Version"]) for a in files ]
+        source = OPJ("etc", "apt", "sources.list.d", "local-packages.list")
+        with ib.builder() as s1:
+            if archive_cache:
+                apt_archive_cache(s1, gbc)
+            chroot_bind(s1, gbc.debian, os.path.abspath("packages"), LOCAL_REPO, readonly=True)
+            with open(OPJ(gbc.debian, source), "w") as f:
+                print("deb [trusted=yes] file:%s ./" % LOCAL_REPO, file=f)
+            apt_get(s1, gbc.debian, [ '-o', 'Dir::Etc::SourceList=/%s' % source,
+                                      '-o', 'Dir::Etc::SourceParts=-',
+                                      '-o', 'APT::Get::List-Cleanup=0', 'update' ])
+            apt_get(s1, gbc.debian, [ '-y', 'install' ] + wanted)
+            ib.file.rm(s1, OPJ(gbc.debian, source))
+            for a in glob.glob(OPJ(gbc.debian, "var", "lib", "apt", "lists", "*%s*" % LOCAL_REPO.replace("/", "_"))):
+                ib.file.rm(s1, a)
+        apt_get(s, gbc.debian, ['clean'])
+        if os.path.exists(OPJ(gbc.debian, "etc", "kernel", "postinst.d", "zz-u-boot")):
+            for version in sorted(os.listdir(OPJ(gbc.debian, "lib", "modules"))):
+                run_chroot(s, gbc.debian, [ '/etc/kernel/postinst.d/zz-u-boot', version ])
+
+@ib.buildcmd()
+class prepare_rootfs(object):
     def run(self, s, gbc):
-        for a in glob.glob(OPJ("packages", "raspberrypi-firmware-git-*.deb")):
-            install_deb(s, gbc.debian, a)
-        for a in glob.glob(OPJ("packages", "u-boot-%s-git-*.deb" % gbc.build)):
-            install_deb(s, gbc.debian, a)
-        for a in glob.glob(OPJ("packages", "linux-*.deb")):
-            install_deb(s, gbc.debian, a)
+        download_repo(s, gbc)
+        ib.file.rm(s, OPJ(gbc.debian, "etc", "resolv.conf"))
+        ib.check_subprocess(s, [ "cp", "-L", "/etc/resolv.conf", OPJ(gbc.debian, "etc", "resolv.conf") ])
+        disable_services(s, gbc.debian)
+
+# apt dates a download by its Last-Modified and leaves a reused .deb alone, so
+# neither says when it was last needed. Touch the archive of everything the
+# rootfs has installed, which is what eviction goes by.
+@ib.buildcmd()
+class touch_used_archives(object):
+    def run(self, s, gbc):
+        proc = subprocess.Popen([ 'chroot', gbc.debian, 'dpkg-query', '-W', '-f',
+                '${Package}_${Version}_${Architecture}.deb\n' ], stdout=subprocess.PIPE)
+        out = proc.communicate()[0]
+        if proc.returncode != 0:
+            raise ib.BuilderError("Can't list the packages installed in %s" % gbc.debian)
+        self.touched = 0
+        for name in out.decode('utf-8').split():
+            path = OPJ(APT_CACHE, name.replace(":", "%3a"))
+            if os.path.exists(path):
+                os.utime(path)
+                self.touched += 1
+        s.debug("Marked %d archives in %s as used", self.touched, APT_CACHE)
+
+@ib.buildcmd()
+class install_base_packages(object):
+    def run(self, s, gbc):
+        with ib.builder() as s1:
+            apt_archive_cache(s1, gbc)
+            apt_get(s1, gbc.debian, ['update'])
+            apt_get(s1, gbc.debian, ['-y', 'install'] + BASE_PACKAGES)
+            touch_used_archives(s1, gbc)
+        apt_get(s, gbc.debian, ['clean'])
+        ib.cache.evict(s, APT_CACHE, APT_CACHE_SIZE, "*.deb")
+
+TAR_ARGS = [ '--numeric-owner', '--xattrs', '--xattrs-include=*' ]
+
+@ib.buildcmd()
+class save_layer(object):
+    def run(self, s, gbc, name, key):
+        tarball = OPJ(gbc.tmp, "layer-%s.tar.gz" % name)
+        with open(tarball, "wb") as f:
+            ib.check_subprocess(s, [ 'tar' ] + TAR_ARGS + [ '-C', gbc.debian, '-zcf', '-', '.' ], stdout=f)
+        ib.cache.store(s, ROOTFS_CACHE, name, key, [ tarball ])
+        ib.file.rm(s, tarball)
+
+@ib.buildcmd()
+class restore_layer(object):
+    def run(self, s, gbc, tarball):
+        with open(tarball, "rb") as f:
+            ib.check_subprocess(s, [ 'tar' ] + TAR_ARGS + [ '-C', gbc.debian,
+                '--exclude=./boot/firmware', '-zxpf', '-' ], stdin=f)
+        with open(tarball, "rb") as f:
+            ib.check_subprocess(s, [ 'tar', '-C', gbc.debian, '--no-same-owner',
+                '--no-same-permissions', '-zxf', '-', './boot/firmware' ], stdin=f)
+
+def layer_keys(gbc, layers):
+    key = ib.cache.key(DEBIAN_VER, MIRROR, os.path.basename(base_tarball(gbc)))
+    keys = []
+    for name, parts, command in [ l[:3] for l in layers ]:
+        key = ib.cache.key(key, name, *parts)
+        keys.append(key)
+    return keys
+
+@ib.buildcmd()
+class build_rootfs(object):
+    def run(self, s, gbc, layers):
+        start = 0
+        if base_tarball(gbc) != None:
+            keys = layer_keys(gbc, layers)
+            for i in reversed(range(len(layers))):
+                cached = ib.cache.lookup(s, ROOTFS_CACHE, layers[i][0], keys[i]).files
+                if cached:
+                    s.info("Restoring cached rootfs layer %s", layers[i][0])
+                    restore_layer(s, gbc, cached[0])
+                    start = i + 1
+                    break
+        if start == 0:
+            prepare_rootfs(s, gbc)
+            keys = layer_keys(gbc, layers)
+        for i in range(start, len(layers)):
+            name, parts, command = layers[i][:3]
+            command(s, gbc, *layers[i][3:])
+            save_layer(s, gbc, name, keys[i])
+
+def image_name(gbc):
+    return "r%s-next-%s.img" % (gbc.build, gbc.today)
 
 @ib.buildcmd()
 class move_image(object):
     def run(self, s, gbc):
-        with open("r%s-next-%s.img.gz" % (gbc.build, gbc.today), "wb") as f1:
-            with open(gbc.img, "rb") as f2:
-                ib.check_subprocess(s, [ "gzip", "-c" ], stdin=f2, stdout=f1)
+        name = image_name(gbc)
+        ib.compress.image(s, gbc.img, "%s.%s" % (name, IMAGE_COMPRESSION),
+                IMAGE_COMPRESSION, bmap="%s.bmap" % name)
+
+@ib.buildcmd()
+class create_delta(object):
+    def run(self, s, gbc):
+        previous = PREVIOUS_IMAGE.replace("{build}", gbc.build)
+        if not os.path.exists(previous):
+            s.warning("Previous image %s doesn't exist, not creating a delta", previous)
+            return
+        if previous.rsplit(".", 1)[-1] in ib.compress.FORMATS:
+            old = OPJ(gbc.tmp, "previous.img")
+            ib.compress.decompress(s, previous, old)
+        else:
+            old = previous
+        ib.delta.create(s, old, gbc.img, "%s.delta" % image_name(gbc))
 
 @ib.buildcmd()
 class remove_keys(object):
@@ -184,58 +396,94 @@ class add_user(object):
     def run(self, s, gbc, user):
         run_chroot(s, gbc.debian, [ "useradd", "-m", "-s", "/bin/bash", user ])
 
-with ib.builder() as s:
-    ib.check_root(s)
-    gbc = setup_gbc(s).gbc
+@ib.buildcmd()
+class configure_rootfs(object):
+    def run(self, s, gbc):
+        remove_keys(s, gbc)
+        run_chroot(s, gbc.debian, [ 'systemctl', 'enable', 'systemd-networkd.service' ])
+        run_chroot(s, gbc.debian, [ 'systemctl', 'enable', 'systemd-resolved.service' ])
+        run_chroot(s, gbc.debian, [ 'systemctl', 'enable', 'systemd-timesyncd.service' ])
 
-    if len(sys.argv) != 2:
-        print("Usage: %s <pi2|pi3>" % sys.argv[0])
-        sys.exit(1)
-    elif sys.argv[1] == "pi2":
-        gbc.build = "pi2"
-    elif sys.argv[1] == "pi3":
-        gbc.build = "pi3"
-    else:
-        print("Usage: %s <pi2|pi3>" % sys.argv[0])
-        sys.exit(1)
+        run_chroot(s, gbc.debian, [ 'rm', '/etc/resolv.conf' ])
+        run_chroot(s, gbc.debian, [ 'ln', '-s', '/run/systemd/resolve/resolv.conf', '/etc/resolv.conf' ])
+        ib.overlay.apply(s, "overlay", gbc.debian, OVERLAY_RULES, variants=BOARDS)
 
-    with ib.builder() as s1:
-        create_image(s1, gbc)
-        create_partitions(s1, gbc)
-        format_partitions(s1, gbc)
-        mount_partitions(s1, gbc)
-        download_repo(s1, gbc)
-        ib.file.rm(s1, OPJ(gbc.debian, "etc", "resolv.conf"))
-        ib.check_subprocess(s1, [ "cp", "-L", "/etc/resolv.conf", OPJ(gbc.debian, "etc", "resolv.conf") ])
-
-        disable_services(s1, gbc.debian)
-        apt_get(s1, gbc.debian, ['update'])
-        apt_get(s1, gbc.debian, ['-y', 'install', 'openssh-client',
-                                 'openssh-server', 'initramfs-tools', 'btrfs-tools', 'parted',
-                                 'wpasupplicant'])
-        apt_get(s1, gbc.debian, ['clean'])
-        install_packages(s1, gbc)
-        remove_keys(s1, gbc)
-        run_chroot(s1, gbc.debian, [ 'systemctl', 'enable', 'systemd-networkd.service' ])
-        run_chroot(s1, gbc.debian, [ 'systemctl', 'enable', 'systemd-resolved.service' ])
-        run_chroot(s1, gbc.debian, [ 'systemctl', 'enable', 'systemd-timesyncd.service' ])
-
-        run_chroot(s1, gbc.debian, [ 'rm', '/etc/resolv.conf' ])
-        run_chroot(s1, gbc.debian, [ 'ln', '-s', '/run/systemd/resolve/resolv.conf', '/etc/resolv.conf' ])
-        overlay(s1, gbc.debian, "/etc/cron.d/FIRST_BOOT_SSH", 0, 0, 0o644)
-        overlay(s1, gbc.debian, "/etc/cron.d/FIRST_BOOT_PARTITION", 0, 0, 0o644)
-        overlay(s1, gbc.debian, "/etc/systemd/network/eth.network", 0, 0, 0o644)
-        overlay(s1, gbc.debian, "/etc/systemd/network/enx.network", 0, 0, 0o644)
-        overlay(s1, gbc.debian, "/etc/systemd/system/wpa_supplicant@.service", 0, 0, 0o644)
-        overlay(s1, gbc.debian, "/etc/fstab", 0, 0, 0o644)
+@ib.buildcmd()
+class configure_board(object):
+    def run(self, s, gbc):
+        install_packages(s, gbc, board_package_files(gbc.build), archive_cache=False)
         with open(OPJ(gbc.debian, "etc", "hostname"), "w") as f:
             print("%s-next" % gbc.build, file=f)
-        ib.file.chmod(s1, OPJ(gbc.debian, "etc", "hostname"), 0o644)
-        soverlay(s1, gbc, gbc.debian, "/boot/uboot_params.txt", 0, 0, 0o644)
-        set_password(s1, gbc, "root", "%s-next" % gbc.build)
+        ib.file.chmod(s, OPJ(gbc.debian, "etc", "hostname"), 0o644)
+        ib.overlay.apply(s, "overlay", gbc.debian, OVERLAY_RULES, gbc.build, BOARDS)
+        set_password(s, gbc, "root", "%s-next" % gbc.build)
+
+        add_user(s, gbc, "%s-next" % gbc.build)
+        set_password(s, gbc, "%s-next" % gbc.build, "%s-next" % gbc.build)
+
+        enable_services(s, gbc.debian)
+
+@ib.buildcmd()
+class build_board(object):
+    def run(self, s, build, gbc, shared):
+        gbc = copy.copy(gbc)
+        gbc.build = build
+        gbc.tmp = ib.mkdtemp(s, path=gbc.tmp).path
+        if shared:
+            gbc.debian = stage_tree(s, OPJ(gbc.tmp, DEBIAN_VER), gbc.debian).path
+        configure_board(s, gbc)
+        ib.manifest.write(s, gbc.debian, "%s.manifest" % image_name(gbc))
+        if IMAGE_ASSEMBLY == "tree":
+            assemble_image(s, gbc)
+        else:
+            with ib.builder() as s1:
+                create_image(s1, gbc)
+                create_partitions(s1, gbc)
+                format_partitions(s1, gbc)
+                mount_partitions(s1, gbc)
+                copy_rootfs(s1, gbc.debian, gbc.mnt)
+        ib.sparsify(s, gbc.img)
+        if PREVIOUS_IMAGE:
+            create_delta(s, gbc)
+        move_image(s, gbc)
+
+def usage():
+    print("Usage: %s <%s> [%s ...]" % (sys.argv[0], "|".join(BOARDS), "|".join(BOARDS)))
+    print("")
+    print("IMAGE_ASSEMBLY=mount (the default) partitions a loop device and must run as root.")
+    print("IMAGE_ASSEMBLY=tree builds the partition images straight from the staged rootfs")
+    print("without loop devices or mounts. Staging the rootfs still runs debootstrap, chroot")
+    print("and bind mounts, so those steps need root or a container that allows them.")
+    sys.exit(1)
+
+with ib.builder() as s:
+    if IMAGE_ASSEMBLY not in [ "mount", "tree" ]:
+        print("IMAGE_ASSEMBLY must be one of mount, tree")
+        sys.exit(1)
+    # tree assembly needs no loop devices or mounts, so only the staging steps
+    # (debootstrap, chroot, bind mounts) want privileges, and they fail by
+    # themselves without them
+    if IMAGE_ASSEMBLY == "mount":
+        ib.check_root(s)
+    ib.journal.recover(s)
+    gbc = setup_gbc(s).gbc
+
+    if IMAGE_COMPRESSION not in ib.compress.FORMATS:
+        print("IMAGE_COMPRESSION must be one of %s" % ", ".join(ib.compress.FORMATS))
+        sys.exit(1)
 
-        add_user(s1, gbc, "%s-next" % gbc.build)
-        set_password(s1, gbc, "%s-next" % gbc.build, "%s-next" % gbc.build)
+    boards = sys.argv[1:]
+    if len(boards) == 0 or len(set(boards)) != len(boards):
+        usage()
+    for build in boards:
+        if build not in BOARDS:
+            usage()
 
-        enable_services(s1, gbc.debian)
-    move_image(s, gbc)
+    gbc.debian = stage_tree(s, OPJ(gbc.tmp, DEBIAN_VER)).path
+    snapshot = os.getenv('MIRROR_SNAPSHOT', gbc.today[:8])
+    build_rootfs(s, gbc, [
+        ("apt", [ snapshot ] + BASE_PACKAGES, install_base_packages),
+        ("packages", [ ib.cache.hash_files(common_package_files()) ], install_packages, common_package_files()),
+    ])
+    configure_rootfs(s, gbc)
+    ib.scheduler.each(s, build_board, boards, gbc, len(boards) > 1, jobs=len(boards))
@@ -9,16 +9,21 @@ import tempfile
 import shutil
 import sys
 import atexit
+import threading
+import collections
+import selectors
 
 import functools
 import logging
-import colorlog
 
 IMAGE_SIZE = 1024*1024*512
+LOG_LINES = int(os.getenv('BUILD_LOG_LINES', '50'))
 
 class BuilderError(Exception):
-    def __init__(self, value):
+    def __init__(self, value, output=None, log=None):
         self.value = value
+        self.output = output
+        self.log = log
     def __str__(self):
         return repr(self.value)
 
@@ -51,6 +56,14 @@ class buildcmd_name(object):
         c.buildcmd_name = self.name
         return c
 
+class buildcmd_depends(object):
+    def __init__(self, *depends):
+        self.depends = depends
+
+    def __call__(self, c):
+        c.buildcmd_depends = self.depends
+        return c
+
 class buildcmd_once(object):
     def __init__(self):
         pass
@@ -58,16 +71,33 @@ class buildcmd_once(object):
     def __call__(self, c):
         class buildcmd_once_wrapper(c):
             def run(self, builder, *args, **kwargs):
-                if not hasattr(buildcmd_once_wrapper, 'buildcmd_once'):
-                    super(buildcmd_once_wrapper, self).run(builder, *args, **kwargs)
-                    buildcmd_once_wrapper.buildcmd_once = True
-                    buildcmd_once_wrapper.buildcmd_flatten = True
+                with buildcmd_once_wrapper.buildcmd_once_lock:
+                    if not hasattr(buildcmd_once_wrapper, 'buildcmd_once'):
+                        super(buildcmd_once_wrapper, self).run(builder, *args, **kwargs)
+                        buildcmd_once_wrapper.buildcmd_once = True
+                        buildcmd_once_wrapper.buildcmd_flatten = True
+        buildcmd_once_wrapper.buildcmd_once_lock = threading.Lock()
         buildcmd_once_wrapper.__doc__ = c.__doc__
         buildcmd_once_wrapper.__name__ = c.__name__
         return buildcmd_once_wrapper
 
 import image_builder.file
 import image_builder.loopback
+import image_builder.scheduler
+import image_builder.cache
+import image_builder.compress
+import image_builder.aptrepo
+import image_builder.trace
+import image_builder.deb
+import image_builder.ubootenv
+import image_builder.ccache
+import image_builder.jobserver
+import image_builder.assemble
+import image_builder.manifest
+import image_builder.delta
+import image_builder.overlay
+import image_builder.journal
+import image_builder.log
 
 @buildcmd()
 @buildcmd_flatten()
@@ -75,35 +105,110 @@ class check_subprocess(object):
     def run(self, s, cmd, *args, **kwargs):
         a = subprocess(s, cmd, *args, **kwargs)
         if a.returncode != 0:
-            raise BuilderError("%s returned %d" % (cmd, a.returncode))
+            for line in a.tail:
+                s.error("| %s", line)
+            msg = "%s returned %d" % (cmd, a.returncode)
+            if a.log:
+                msg += " (output in %s)" % a.log
+            raise BuilderError(msg, output=list(a.tail), log=a.log)
+
+class _SubprocessLogs(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.directory = None
+        self.count = 0
+
+    def path(self, cmd):
+        with self.lock:
+            if self.directory is None:
+                self.directory = os.getenv('BUILD_LOG_DIR') or os.path.join(os.getcwd(), "logs",
+                        "%s-%d" % (time.strftime("%Y%m%d-%H%M%S"), os.getpid()))
+                os.makedirs(self.directory, exist_ok=True)
+            self.count += 1
+            count = self.count
+        name = "-".join(os.path.basename(str(a)) for a in cmd[:3])
+        name = re.sub(r"[^A-Za-z0-9_.+-]", "_", name)[:48]
+        return os.path.join(self.directory, "%04d-%s.log" % (count, name))
+
+subprocess_logs = _SubprocessLogs()
 
 @buildcmd()
 @buildcmd_flatten()
 class subprocess(object):
-    def run(self, s, cmd, *args, **kwargs):
-        defaults = {"stdout": sys.stderr}
-        defaults.update(kwargs)
+    def run(self, s, cmd, *args, passthrough=False, **kwargs):
         s.debug("Executing %s", cmd)
+        self.tail = collections.deque(maxlen=LOG_LINES)
+        self.log = None
+        captured = []
+        if not passthrough and os.getenv('BUILD_VERBOSE', '0') != '1':
+            for stream in ('stdout', 'stderr'):
+                if stream not in kwargs:
+                    kwargs[stream] = sp.PIPE
+                    captured.append(stream)
+        if captured:
+            self.log = subprocess_logs.path(cmd)
         with sp.Popen(cmd, *args, **kwargs) as proc:
-            proc.wait()
+            if captured:
+                self.pump(proc, [ getattr(proc, a) for a in captured ])
+            pid, status, rusage = os.wait4(proc.pid, 0)
+            proc.returncode = os.waitstatus_to_exitcode(status)
             self.returncode = proc.returncode
+        self.rusage = {
+            "utime": rusage.ru_utime,
+            "stime": rusage.ru_stime,
+            "maxrss_kb": rusage.ru_maxrss,
+            "inblock": rusage.ru_inblock,
+            "oublock": rusage.ru_oublock,
+        }
+        s.debug("%s exited with %d (user %.2fs, sys %.2fs, max rss %d KiB, in %d, out %d blocks)",
+                os.path.basename(str(cmd[0])), self.returncode, rusage.ru_utime, rusage.ru_stime,
+                rusage.ru_maxrss, rusage.ru_inblock, rusage.ru_oublock)
+
+    def pump(self, proc, streams):
+        partial = {}
+        with open(self.log, "wb") as log, selectors.DefaultSelector() as sel:
+            for f in streams:
+                sel.register(f, selectors.EVENT_READ)
+                partial[f] = b''
+            while sel.get_map():
+                for key, mask in sel.select():
+                    data = os.read(key.fd, 65536)
+                    if not data:
+                        sel.unregister(key.fileobj)
+                        if partial[key.fileobj]:
+                            self.tail.append(partial[key.fileobj].decode('utf-8', 'replace'))
+                        continue
+                    log.write(data)
+                    lines = (partial[key.fileobj] + data).split(b'\n')
+                    partial[key.fileobj] = lines.pop()
+                    for line in lines[-LOG_LINES:]:
+                        self.tail.append(line.decode('utf-8', 'replace'))
 
 @buildcmd()
 class mkdtemp(object):
     def run(self, s, path=None):
         self.path = tempfile.mkdtemp(dir=path)
+        image_builder.journal.acquire(self, "tree", os.path.realpath(self.path))
         s.debug("Created temporary directory %s", self.path)
     def cleanup(self, s):
         s.debug("Removing temporary directory %s", self.path)
-        shutil.rmtree(self.path)
+        image_builder.journal.remove_tree(s, self.path)
+        image_builder.journal.release(self)
 
 @buildcmd()
 class empty_image(object):
     def run(self, s, path, size):
         self.path = path
+        s.debug("Allocating sparse image %s (%d bytes)", path, size)
         with open(self.path, "wb") as out:
-            out.seek(size - 1)
-            out.write(b'\0')
+            out.truncate(size)
+
+@buildcmd()
+@buildcmd_flatten()
+class sparsify(object):
+    def run(self, s, path):
+        s.debug("Punching holes in zeroed regions of %s", path)
+        check_subprocess(s, ['fallocate', '--dig-holes', path])
 
 @buildcmd()
 @buildcmd_flatten()
@@ -115,11 +220,31 @@ class mount(object):
             cmd.extend(['-o', options])
 
         check_subprocess(s, cmd)
+        image_builder.journal.acquire(self, "mount", os.path.realpath(path), device)
 
     def cleanup(self, s):
-        ret = subprocess(s, ['umount', self._path]).returncode
+        ret = image_builder.journal.umount(s, self._path)
         if ret != 0:
             s.warning("umount returned %d", ret)
+        else:
+            image_builder.journal.release(self)
+
+@buildcmd()
+@buildcmd_flatten()
+class bind_mount(object):
+    def run(self, s, src, path, readonly=False):
+        self._path = path
+        check_subprocess(s, ['mount', '--bind', src, path])
+        image_builder.journal.acquire(self, "mount", os.path.realpath(path), os.path.realpath(src))
+        if readonly:
+            check_subprocess(s, ['mount', '-o', 'remount,bind,ro', path])
+
+    def cleanup(self, s):
+        ret = image_builder.journal.umount(s, self._path)
+        if ret != 0:
+            s.warning("umount returned %d", ret)
+        else:
+            image_builder.journal.release(self)
 
 @buildcmd()
 class extract_release(object):
@@ -236,29 +361,30 @@ class mount_image(object):
 class builder(object):
     logger_init = False
 
-    def __init__(self):
-        self.buildcmd_count = {}
-        self.buildcmd_stack = []
+    def __init__(self, parent=None):
+        self.parent = parent
+        if parent:
+            self.lock = parent.lock
+            self.buildcmd_count = parent.buildcmd_count
+            self.buildcmd_stack = list(parent.buildcmd_stack)
+            self.depth = parent.depth
+        else:
+            self.lock = threading.Lock()
+            self.buildcmd_count = {}
+            self.buildcmd_stack = []
+            self.depth = 0
         self.exit_callbacks = []
         self.logger = logging.getLogger('image_builder')
         if not builder.logger_init:
-            ch = logging.StreamHandler()
-            ch.setFormatter(colorlog.ColoredFormatter(
-                "%(log_color)s%(levelname)-8s%(reset)s %(message)s",
-                datefmt=None,
-                reset=True,
-                log_colors={
-                    'DEBUG':    'cyan',
-                    'INFO':     'green',
-                    'WARNING':  'yellow',
-                    'ERROR':    'red',
-                    'CRITICAL': 'red,bg_white',
-                },
-                style='%'))
-            self.logger.addHandler(ch)
-            self.logger.setLevel(logging.DEBUG)
+            image_builder.log.setup(self.logger)
             builder.logger_init = True
+            atexit.register(image_builder.trace.report)
         self.in_exit = True
+        if parent:
+            self.in_exit = parent.in_exit
+
+    def fork(self):
+        return builder(parent=self)
 
     def __enter__(self):
         self.in_exit = False
@@ -266,11 +392,13 @@ class builder(object):
 
     def __exit__(self, type, value, traceback):
         self.in_exit = True
-        for o in self.exit_callbacks:
-            if not o._run_failed:
-                self.info("Cleanup handler for %s", self.buildcmd_name(o))
-                o.cleanup(self)
+        callbacks = [ o for o in self.exit_callbacks if not o._run_failed ]
         self.exit_callbacks = []
+        try:
+            image_builder.journal.teardown(self, callbacks)
+        finally:
+            if not self.parent:
+                image_builder.log.flush()
 
     def buildcmd_name(self, o):
         if hasattr(o, 'buildcmd_name'):
@@ -278,11 +406,14 @@ class builder(object):
         return o.__class__.__name__
 
     def register_exit_callback(self, o):
+        if self.parent:
+            return self.parent.register_exit_callback(o)
         if hasattr(o, 'cleanup'):
             if self.in_exit:
                 self.error("Ran buildcmd %s with cleanup handler in __exit__, ignoring!", self.buildcmd_name(o))
             else:
-                self.exit_callbacks.insert(0, o)
+                with self.lock:
+                    self.exit_callbacks.insert(0, o)
 
     def run(self, o, *args, **kwargs):
         name = self.buildcmd_name(o)
@@ -293,50 +424,70 @@ class builder(object):
 
         if not wants_flatten:
             self.info("Started %s {", name)
+        parent = None
+        if self.buildcmd_stack:
+            parent = self.buildcmd_stack[-1][0]._trace_event
+        o._trace_event = image_builder.trace.tracer.begin(name, parent, args, kwargs)
         self.buildcmd_stack.append((o, wants_flatten))
+        if not wants_flatten:
+            self.depth += 1
 
         ts = time.time()
+        status = "error"
         try:
             o._run_failed = True
             self.register_exit_callback(o)
             o.result = o.run(self, *args, **kwargs)
             o._run_failed = False
-        except:
+            status = "ok"
+        except Exception as e:
+            status = "error: %s" % e
             self.error("Exception occurred during execution of %s", name)
             raise
         finally:
             te = time.time()
+            extra = {}
+            if hasattr(o, 'returncode'):
+                extra["returncode"] = o.returncode
+            if hasattr(o, 'rusage'):
+                extra["rusage"] = o.rusage
+            if getattr(o, 'log', None):
+                extra["log"] = o.log
+            image_builder.trace.tracer.end(o._trace_event, status, extra)
             self.buildcmd_stack.pop()
             if not wants_flatten:
+                self.depth -= 1
                 delta = te - ts
                 if delta >= 0.01:
                     self.info("} (%2.2f seconds)", delta)
                 else:
                     self.info("}")
 
-        if name in self.buildcmd_count:
-            self.buildcmd_count[name] += 1
-        else:
-            self.buildcmd_count[name] = 1
+        with self.lock:
+            if name in self.buildcmd_count:
+                self.buildcmd_count[name] += 1
+            else:
+                self.buildcmd_count[name] = 1
 
-    def current_indent(self):
-        stacksize = len([1 for o, flatten in self.buildcmd_stack if not flatten])
-        return "    " * stacksize
+    def log(self, level, msg, *args, **kwargs):
+        if self.logger.isEnabledFor(level):
+            o = self.buildcmd_stack[-1][0] if self.buildcmd_stack else None
+            self.logger.log(level, msg, *args, extra={ "depth": self.depth, "buildcmd": o }, **kwargs)
 
     def debug(self, msg, *args, **kwargs):
-        self.logger.debug(self.current_indent() + msg, *args, **kwargs)
+        self.log(logging.DEBUG, msg, *args, **kwargs)
 
     def error(self, msg, *args, **kwargs):
-        self.logger.error(self.current_indent() + msg, *args, **kwargs)
+        self.log(logging.ERROR, msg, *args, **kwargs)
 
     def critical(self, msg, *args, **kwargs):
-        self.logger.critical(self.current_indent() + msg, *args, **kwargs)
+        self.log(logging.CRITICAL, msg, *args, **kwargs)
 
     def info(self, msg, *args, **kwargs):
-        self.logger.info(self.current_indent() + msg, *args, **kwargs)
+        self.log(logging.INFO, msg, *args, **kwargs)
 
     def warn(self, msg, *args, **kwargs):
-        self.logger.warn(self.current_indent() + msg, *args, **kwargs)
+        self.log(logging.WARNING, msg, *args, **kwargs)
 
     def warning(self, msg, *args, **kwargs):
-        self.logger.warning(self.current_indent() + msg, *args, **kwargs)
+        self.log(logging.WARNING, msg, *args, **kwargs)
@@ -0,0 +1,13 @@
+import image_builder as ib
+import sys
+
+COMMANDS = {
+    "delta": ib.delta.main,
+    "journal": ib.journal.main,
+    "manifest": ib.manifest.main,
+}
+
+if len(sys.argv) < 2 or sys.argv[1] not in COMMANDS:
+    print("Usage: python3 -m image_builder <%s> ..." % "|".join(sorted(COMMANDS)), file=sys.stderr)
+    sys.exit(2)
+sys.exit(COMMANDS[sys.argv[1]](sys.argv[1:]))
@@ -0,0 +1,127 @@
+import image_builder as ib
+import email.utils
+import glob
+import gzip
+import hashlib
+import io
+import os
+import subprocess
+import tarfile
+import threading
+
+def ar_members(path):
+    with open(path, "rb") as f:
+        if f.read(8) != b"!<arch>\n":
+            raise ib.BuilderError("%s is not an ar archive" % path)
+        while True:
+            header = f.read(60)
+            if len(header) < 60:
+                return
+            name = header[0:16].decode('ascii').strip().rstrip('/')
+            size = int(header[48:58].decode('ascii'))
+            yield name, f.read(size)
+            if size % 2:
+                f.read(1)
+
+def control(path):
+    for name, data in ar_members(path):
+        if name.startswith("control.tar"):
+            try:
+                with tarfile.open(fileobj=io.BytesIO(data), mode="r:*") as tar:
+                    for member in tar.getmembers():
+                        if member.name in ("./control", "control"):
+                            return tar.extractfile(member).read().decode('utf-8')
+            except tarfile.TarError:
+                break
+    return subprocess.check_output([ 'dpkg-deb', '-f', path ]).decode('utf-8')
+
+def parse(text):
+    stanzas = []
+    fields = {}
+    last = None
+    for line in text.splitlines():
+        if not line.strip():
+            if fields:
+                stanzas.append(fields)
+            fields = {}
+            last = None
+        elif line[0] in " \t" and last:
+            fields[last] += "\n" + line
+        else:
+            last, value = line.split(":", 1)
+            fields[last] = value.strip()
+    if fields:
+        stanzas.append(fields)
+    return stanzas
+
+def digests(path):
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            md5.update(chunk)
+            sha256.update(chunk)
+    return md5.hexdigest(), sha256.hexdigest()
+
+def packages(directory):
+    with open(os.path.join(directory, "Packages"), "r") as f:
+        return parse(f.read())
+
+def write_atomic(path, data):
+    with open(path + ".new", "wb") as f:
+        f.write(data)
+    os.rename(path + ".new", path)
+
+@ib.buildcmd()
+@ib.buildcmd_name("aptrepo.index")
+class index(object):
+    def run(self, s, directory):
+        stanzas = []
+        for a in sorted(glob.glob(os.path.join(directory, "*.deb"))):
+            s.debug("Indexing %s", a)
+            md5, sha256 = digests(a)
+            stanzas.append("%s\nFilename: ./%s\nSize: %d\nMD5sum: %s\nSHA256: %s\n" % (
+                control(a).rstrip("\n"), os.path.basename(a), os.path.getsize(a), md5, sha256))
+        text = "\n".join(stanzas).encode('utf-8')
+        write_atomic(os.path.join(directory, "Packages"), text)
+        write_atomic(os.path.join(directory, "Packages.gz"), gzip.compress(text, mtime=0))
+
+        release = [ "Date: %s" % email.utils.formatdate(usegmt=True) ]
+        files = [ "Packages", "Packages.gz" ]
+        for title, algo in [ ("MD5Sum", hashlib.md5), ("SHA256", hashlib.sha256) ]:
+            release.append("%s:" % title)
+            for a in files:
+                with open(os.path.join(directory, a), "rb") as f:
+                    data = f.read()
+                release.append(" %s %d %s" % (algo(data).hexdigest(), len(data), a))
+        write_atomic(os.path.join(directory, "Release"), ("\n".join(release) + "\n").encode('utf-8'))
+        self.count = len(stanzas)
+        s.debug("Indexed %d packages in %s", self.count, directory)
+
+refresh_lock = threading.Lock()
+
+def debs_key(directory):
+    parts = []
+    for a in sorted(glob.glob(os.path.join(directory, "*.deb"))):
+        st = os.stat(a)
+        parts.append("%s:%d:%d" % (os.path.basename(a), st.st_size, st.st_mtime_ns))
+    return ib.cache.key(*parts)
+
+# Reindexes only when the set of .debs, their sizes or mtimes changed since
+# the last index, as recorded in .Packages.stamp.
+@ib.buildcmd()
+@ib.buildcmd_name("aptrepo.refresh")
+@ib.buildcmd_flatten()
+class refresh(object):
+    def run(self, s, directory):
+        stamp = os.path.join(directory, ".Packages.stamp")
+        with refresh_lock:
+            wanted = debs_key(directory)
+            current = None
+            if os.path.exists(stamp) and os.path.exists(os.path.join(directory, "Packages")):
+                with open(stamp, "r") as f:
+                    current = f.read().strip()
+            self.indexed = current != wanted
+            if self.indexed:
+                index(s, directory)
+                write_atomic(stamp, (wanted + "\n").encode('utf-8'))
@@ -0,0 +1,132 @@
+import image_builder as ib
+import errno
+import os
+import stat
+
+SECTOR = 512
+
+# Partitions are (name, start sector, size in sectors or None for the rest of
+# the disk, sfdisk type).
+def sfdisk_script(partitions):
+    lines = [ "label: dos", "unit: sectors", "" ]
+    for name, start, size, ptype in partitions:
+        if size is None:
+            lines.append("start=%d, type=%s" % (start, ptype))
+        else:
+            lines.append("start=%d, size=%d, type=%s" % (start, size, ptype))
+    return "\n".join(lines) + "\n"
+
+def partition_bytes(partitions, image_size):
+    result = {}
+    for name, start, size, ptype in partitions:
+        if size is None:
+            size = image_size // SECTOR - start
+        result[name] = (start * SECTOR, size * SECTOR)
+    return result
+
+def make_dir(from_path, to_path):
+    st = os.lstat(from_path)
+    os.mkdir(to_path, stat.S_IMODE(st.st_mode))
+    try:
+        os.chown(to_path, st.st_uid, st.st_gid)
+    except PermissionError:
+        pass
+    return st
+
+def copy_entry(src, dst):
+    st = os.lstat(src)
+    if stat.S_ISREG(st.st_mode):
+        ib.file.clone_file(src, dst, stat.S_IMODE(st.st_mode))
+    elif stat.S_ISLNK(st.st_mode):
+        os.symlink(os.readlink(src), dst)
+    else:
+        os.mknod(dst, st.st_mode, st.st_rdev)
+    try:
+        ib.file.copy_metadata(src, dst, st, True)
+    except PermissionError:
+        if not stat.S_ISLNK(st.st_mode):
+            os.chmod(dst, stat.S_IMODE(st.st_mode))
+        os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+
+# Directories are recreated and everything else is hardlinked, so a layout for
+# mkfs costs no data copies. Excluded directories are left as empty mount points.
+# btrfs won't link across subvolumes, as from a staged subvolume into the work
+# directory, so those entries are reflinked or copied instead.
+def hardlink(from_path, to_path, exclude=()):
+    st = make_dir(from_path, to_path)
+    for entry in os.scandir(from_path):
+        src = os.path.join(from_path, entry.name)
+        dst = os.path.join(to_path, entry.name)
+        if not entry.is_dir(follow_symlinks=False):
+            try:
+                os.link(src, dst, follow_symlinks=False)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                copy_entry(src, dst)
+        elif entry.name in exclude:
+            make_dir(src, dst)
+        else:
+            hardlink(src, dst)
+    os.utime(to_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+@ib.buildcmd()
+@ib.buildcmd_name("assemble.link_tree")
+@ib.buildcmd_flatten()
+class link_tree(object):
+    def run(self, s, from_path, to_path, exclude=()):
+        s.debug("Hardlinking %s to %s (excluding %s)", from_path, to_path, ", ".join(exclude))
+        hardlink(from_path, to_path, exclude)
+
+@ib.buildcmd()
+@ib.buildcmd_name("assemble.ext4")
+class ext4(object):
+    def run(self, s, tree, output, size, label=None):
+        ib.empty_image(s, output, size)
+        cmd = [ 'mkfs.ext4', '-q', '-F', '-d', tree ]
+        if label:
+            cmd += [ '-L', label ]
+        ib.check_subprocess(s, cmd + [ output ])
+
+@ib.buildcmd()
+@ib.buildcmd_name("assemble.btrfs")
+class btrfs(object):
+    def run(self, s, tree, output, size, subvolumes=(), label=None):
+        ib.empty_image(s, output, size)
+        cmd = [ 'mkfs.btrfs', '-q', '-f', '--rootdir', tree ]
+        for subvolume in subvolumes:
+            cmd += [ '--subvol', subvolume ]
+        if label:
+            cmd += [ '-L', label ]
+        ib.check_subprocess(s, cmd + [ output ])
+
+@ib.buildcmd()
+@ib.buildcmd_name("assemble.vfat")
+class vfat(object):
+    def run(self, s, tree, output, size, fat=16, label=None):
+        ib.empty_image(s, output, size)
+        cmd = [ 'mkfs.fat', '-F', '%d' % fat ]
+        if label:
+            cmd += [ '-n', label ]
+        ib.check_subprocess(s, cmd + [ output ])
+        entries = sorted(os.listdir(tree))
+        if entries:
+            ib.check_subprocess(s, [ 'mcopy', '-s', '-p', '-m', '-i', output ] +
+                    [ os.path.join(tree, a) for a in entries ] + [ '::/' ])
+
+@ib.buildcmd()
+@ib.buildcmd_name("assemble.stitch")
+class stitch(object):
+    def run(self, s, image, size, partitions, images):
+        ib.empty_image(s, image, size)
+        with open(image + ".sfdisk", "w") as f:
+            f.write(sfdisk_script(partitions))
+        with open(image + ".sfdisk", "r") as f:
+            ib.check_subprocess(s, [ 'sfdisk', '--no-reread', '--no-tell-kernel', image ], stdin=f)
+        ib.file.rm(s, image + ".sfdisk")
+        offsets = partition_bytes(partitions, size)
+        for name, path in images.items():
+            offset, length = offsets[name]
+            if os.stat(path).st_size > length:
+                raise ib.BuilderError("%s is larger than partition %s" % (path, name))
+            ib.file.copy_sparse(s, path, image, offset)
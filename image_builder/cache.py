@@ -0,0 +1,110 @@
+import image_builder as ib
+import hashlib
+import fnmatch
+import os
+import shutil
+import tempfile
+
+def key(*parts):
+    h = hashlib.sha256()
+    for p in parts:
+        h.update(str(p).encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def hash_files(paths):
+    return key(*[p + ":" + hash_file(p) for p in sorted(paths)])
+
+def entry(cache_dir, name, key):
+    return os.path.join(cache_dir, name, key)
+
+def link_or_copy(from_path, to_path):
+    try:
+        os.link(from_path, to_path)
+    except OSError:
+        shutil.copy2(from_path, to_path)
+
+@ib.buildcmd()
+@ib.buildcmd_name("cache.lookup")
+@ib.buildcmd_flatten()
+class lookup(object):
+    def run(self, s, cache_dir, name, key):
+        self.path = entry(cache_dir, name, key)
+        self.files = None
+        if os.path.isdir(self.path):
+            self.files = sorted(os.path.join(self.path, a) for a in os.listdir(self.path))
+            # atime is useless on relatime/noatime mounts; the entry's mtime
+            # records its last use instead. The files themselves are left
+            # alone as they may be hard linked into a tree that watches them.
+            os.utime(self.path)
+            s.debug("Cache hit for %s (%s)", name, key[:12])
+        else:
+            s.debug("Cache miss for %s (%s)", name, key[:12])
+
+@ib.buildcmd()
+@ib.buildcmd_name("cache.store")
+class store(object):
+    def run(self, s, cache_dir, name, key, files):
+        self.path = entry(cache_dir, name, key)
+        parent = os.path.dirname(self.path)
+        os.makedirs(parent, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+        try:
+            for a in files:
+                s.debug("Storing %s in cache as %s/%s", a, name, key[:12])
+                shutil.copyfile(a, os.path.join(tmp, os.path.basename(a)))
+            os.chmod(tmp, 0o755)
+            try:
+                os.rename(tmp, self.path)
+            except OSError:
+                s.debug("Cache entry %s/%s already stored by another builder", name, key[:12])
+        finally:
+            if os.path.isdir(tmp):
+                shutil.rmtree(tmp)
+
+@ib.buildcmd()
+@ib.buildcmd_name("cache.restore")
+@ib.buildcmd_flatten()
+class restore(object):
+    def run(self, s, cache_dir, name, key, to_path):
+        self.files = lookup(s, cache_dir, name, key).files
+        self.hit = self.files is not None
+        if not self.hit:
+            return
+        for a in self.files:
+            dest = os.path.join(to_path, os.path.basename(a))
+            if os.path.exists(dest):
+                if os.path.samefile(a, dest):
+                    continue
+                os.unlink(dest)
+            s.debug("Restoring %s to %s", a, dest)
+            link_or_copy(a, dest)
+
+@ib.buildcmd()
+@ib.buildcmd_name("cache.evict")
+class evict(object):
+    def run(self, s, cache_dir, max_bytes, pattern="*"):
+        entries = []
+        # a file's mtime is its last use; callers touch what they reuse
+        for root, dirs, files in os.walk(cache_dir):
+            for a in fnmatch.filter(files, pattern):
+                path = os.path.join(root, a)
+                st = os.lstat(path)
+                entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for mtime, size, path in entries)
+        self.evicted = 0
+        for mtime, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            s.debug("Evicting %s", path)
+            os.unlink(path)
+            total -= size
+            self.evicted += size
+        s.debug("Cache %s holds %d bytes after evicting %d", cache_dir, total, self.evicted)
@@ -0,0 +1,69 @@
+import image_builder as ib
+import os
+import shutil
+import subprocess
+
+CCACHE = os.getenv('BUILD_CCACHE', 'auto')
+HIT_FIELDS = [ "direct_cache_hit", "preprocessed_cache_hit" ]
+MISS_FIELDS = [ "cache_miss" ]
+
+def stats(path):
+    proc = subprocess.Popen([ path, '--print-stats' ], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    out = proc.communicate()[0]
+    if proc.returncode != 0:
+        return None
+    result = {}
+    for line in out.decode('utf-8').splitlines():
+        parts = line.split("\t")
+        if len(parts) == 2 and parts[1].isdigit():
+            result[parts[0]] = int(parts[1])
+    return result
+
+def delta(before, after, fields):
+    return sum(after.get(f, 0) - before.get(f, 0) for f in fields)
+
+@ib.buildcmd()
+@ib.buildcmd_name("ccache.setup")
+class setup(object):
+    def run(self, s, cache_dir, cross_compile=None):
+        self.path = None
+        self.vars = []
+        if CCACHE == '0':
+            s.info("ccache disabled by BUILD_CCACHE=0")
+            return
+        path = shutil.which('ccache')
+        if path is None:
+            if CCACHE == '1':
+                raise ib.BuilderError("BUILD_CCACHE=1 but ccache is not installed")
+            s.info("ccache not found, compiling without it")
+            return
+        self.path = path
+        if cross_compile is None:
+            cross_compile = os.getenv('CROSS_COMPILE', '')
+        cache_dir = os.path.abspath(cache_dir)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        os.environ['CCACHE_DIR'] = cache_dir
+        os.environ.setdefault('CCACHE_BASEDIR', os.getcwd())
+        self.before = stats(path)
+        if self.before is None:
+            ib.check_subprocess(s, [ path, '-z' ])
+        self.vars = [ 'CC=ccache %sgcc' % cross_compile, 'HOSTCC=ccache gcc' ]
+        s.debug("Using ccache in %s", cache_dir)
+
+    def cleanup(self, s):
+        if self.path is None:
+            return
+        after = stats(self.path)
+        if after is None or self.before is None:
+            proc = subprocess.Popen([ self.path, '-s' ], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            for line in proc.communicate()[0].decode('utf-8').splitlines():
+                s.info("ccache: %s", line)
+            return
+        hits = delta(self.before, after, HIT_FIELDS)
+        misses = delta(self.before, after, MISS_FIELDS)
+        if hits + misses == 0:
+            s.info("ccache: no cacheable compilations")
+        else:
+            s.info("ccache: %d hits, %d misses (%.1f%% hit rate)", hits, misses,
+                    100.0 * hits / (hits + misses))
@@ -0,0 +1,177 @@
+import image_builder as ib
+import collections
+import concurrent.futures
+import hashlib
+import os
+import shutil
+import struct
+import subprocess
+import zlib
+
+BLOCK_SIZE = 4096
+CHUNK_SIZE = 1024*1024
+
+FORMATS = [ "gz", "xz", "zst" ]
+
+def default_threads():
+    return os.cpu_count() or 1
+
+class parallel_gzip(object):
+    def __init__(self, fileobj, threads=None, level=6, block=CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.level = level
+        self.block = block
+        self.threads = threads or default_threads()
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads)
+        self.pending = collections.deque()
+        self.buf = bytearray()
+        self.crc = 0
+        self.size = 0
+        self.fileobj.write(b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff')
+
+    def deflate(self, data):
+        c = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        return c.compress(data) + c.flush(zlib.Z_SYNC_FLUSH)
+
+    def submit(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.pending.append(self.pool.submit(self.deflate, data))
+        while len(self.pending) > self.threads * 2:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def write(self, data):
+        self.buf += data
+        while len(self.buf) >= self.block:
+            self.submit(bytes(self.buf[:self.block]))
+            del self.buf[:self.block]
+
+    def close(self):
+        if self.buf:
+            self.submit(bytes(self.buf))
+            self.buf = bytearray()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.pool.shutdown()
+        self.fileobj.write(zlib.compressobj(self.level, zlib.DEFLATED, -15).flush())
+        self.fileobj.write(struct.pack("<II", self.crc, self.size & 0xffffffff))
+
+class pipe_writer(object):
+    def __init__(self, cmd, fileobj):
+        self.cmd = cmd
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=fileobj)
+
+    def write(self, data):
+        self.proc.stdin.write(data)
+
+    def close(self):
+        self.proc.stdin.close()
+        if self.proc.wait() != 0:
+            raise ib.BuilderError("%s returned %d" % (self.cmd, self.proc.returncode))
+
+def writer(fmt, fileobj, threads=None):
+    threads = threads or default_threads()
+    if fmt == "gz":
+        if shutil.which("pigz"):
+            return pipe_writer([ "pigz", "-c", "-p", "%d" % threads ], fileobj)
+        return parallel_gzip(fileobj, threads)
+    elif fmt == "xz":
+        return pipe_writer([ "xz", "-c", "-T", "%d" % threads ], fileobj)
+    elif fmt == "zst":
+        return pipe_writer([ "zstd", "-c", "-q", "-T%d" % threads ], fileobj)
+    raise ib.BuilderError("Unknown compression format %s" % fmt)
+
+def block_ranges(path, block_size=BLOCK_SIZE):
+    ranges = []
+    for start, length in ib.file.extents(path):
+        first = start // block_size
+        last = (start + length - 1) // block_size
+        if ranges and ranges[-1][1] >= first - 1:
+            ranges[-1][1] = max(ranges[-1][1], last)
+        else:
+            ranges.append([first, last])
+    return ranges
+
+def write_bmap(path, size, ranges, block_size=BLOCK_SIZE):
+    mapped = sum(last - first + 1 for first, last, digest in ranges)
+    lines = [
+        '<?xml version="1.0" ?>',
+        '<bmap version="2.0">',
+        '    <ImageSize> %d </ImageSize>' % size,
+        '    <BlockSize> %d </BlockSize>' % block_size,
+        '    <BlocksCount> %d </BlocksCount>' % ((size + block_size - 1) // block_size),
+        '    <MappedBlocksCount> %d </MappedBlocksCount>' % mapped,
+        '    <ChecksumType> sha256 </ChecksumType>',
+        '    <BmapFileChecksum> %s </BmapFileChecksum>' % ("0" * 64),
+        '    <BlockMap>',
+    ]
+    for first, last, digest in ranges:
+        if first == last:
+            lines.append('        <Range chksum="%s"> %d </Range>' % (digest, first))
+        else:
+            lines.append('        <Range chksum="%s"> %d-%d </Range>' % (digest, first, last))
+    lines.extend([ '    </BlockMap>', '</bmap>', '' ])
+    text = "\n".join(lines)
+    checksum = hashlib.sha256(text.encode('utf-8')).hexdigest()
+    text = text.replace("0" * 64, checksum, 1)
+    with open(path, "w") as f:
+        f.write(text)
+
+@ib.buildcmd()
+@ib.buildcmd_name("compress.image")
+class image(object):
+    def run(self, s, src, dest, fmt="gz", bmap=None, threads=None):
+        size = os.stat(src).st_size
+        ranges = block_ranges(src)
+        zeros = bytes(CHUNK_SIZE)
+        mapped = []
+        s.debug("Compressing %s to %s (%s, %d mapped ranges)", src, dest, fmt, len(ranges))
+
+        def emit_zeros(out, count):
+            while count > 0:
+                n = min(count, CHUNK_SIZE)
+                out.write(zeros if n == CHUNK_SIZE else zeros[:n])
+                count -= n
+
+        with open(dest, "wb") as f, open(src, "rb") as fin:
+            out = writer(fmt, f, threads)
+            offset = 0
+            for first, last in ranges:
+                start = first * BLOCK_SIZE
+                end = min((last + 1) * BLOCK_SIZE, size)
+                emit_zeros(out, start - offset)
+                h = hashlib.sha256()
+                offset = start
+                while offset < end:
+                    data = os.pread(fin.fileno(), min(CHUNK_SIZE, end - offset), offset)
+                    if not data:
+                        raise ib.BuilderError("Short read from %s at %d" % (src, offset))
+                    h.update(data)
+                    out.write(data)
+                    offset += len(data)
+                mapped.append((first, last, h.hexdigest()))
+            emit_zeros(out, size - offset)
+            out.close()
+
+        if bmap:
+            write_bmap(bmap, size, mapped)
+        self.mapped = sum(min((last + 1) * BLOCK_SIZE, size) - first * BLOCK_SIZE
+                for first, last, digest in mapped)
+        s.debug("Compressed %d of %d bytes holding data", self.mapped, size)
+
+DECOMPRESSORS = {
+    "gz": [ "gzip", "-dc" ],
+    "xz": [ "xz", "-dc" ],
+    "zst": [ "zstd", "-dc", "-q" ],
+}
+
+@ib.buildcmd()
+@ib.buildcmd_name("compress.decompress")
+class decompress(object):
+    def run(self, s, src, dest):
+        fmt = src.rsplit(".", 1)[-1]
+        if fmt not in DECOMPRESSORS:
+            raise ib.BuilderError("Don't know how to decompress %s" % src)
+        with open(dest, "wb") as f:
+            ib.check_subprocess(s, DECOMPRESSORS[fmt] + [ src ], stdout=f)
+        ib.sparsify(s, dest)
@@ -0,0 +1,139 @@
+import image_builder as ib
+import fnmatch
+import io
+import os
+import stat
+import tarfile
+import time
+
+def control_text(fields):
+    lines = []
+    for name, value in fields.items():
+        value = str(value).split("\n")
+        lines.append("%s: %s" % (name, value[0]))
+        for a in value[1:]:
+            lines.append(" " + (a if a.strip() else "."))
+    return "\n".join(lines) + "\n"
+
+def tree(from_path, to_path, uid=0, gid=0, exclude=None):
+    entries = []
+    exclude = exclude or []
+    for root, dirs, files in os.walk(from_path):
+        rel = os.path.relpath(root, from_path)
+        rel = "" if rel == "." else rel
+        dirs[:] = sorted(d for d in dirs
+                if not any(fnmatch.fnmatch(os.path.join(rel, d), p) for p in exclude))
+        entries.append((None, os.path.join(to_path, rel).rstrip("/"), uid, gid, 0o755))
+        for a in sorted(files):
+            if any(fnmatch.fnmatch(os.path.join(rel, a), p) for p in exclude):
+                continue
+            src = os.path.join(root, a)
+            st = os.lstat(src)
+            mode = 0o755 if st.st_mode & stat.S_IXUSR else 0o644
+            entries.append((src, os.path.join(to_path, rel, a), uid, gid, mode))
+        for d in dirs:
+            if os.path.islink(os.path.join(root, d)):
+                entries.append((os.path.join(root, d), os.path.join(to_path, rel, d), uid, gid, 0o777))
+        dirs[:] = [ d for d in dirs if not os.path.islink(os.path.join(root, d)) ]
+    return entries
+
+def tar_name(path):
+    return "./" + path.strip("/")
+
+def tarinfo(name, uid, gid, mode, mtime):
+    info = tarfile.TarInfo(name)
+    info.uid = uid
+    info.gid = gid
+    info.uname = "root" if uid == 0 else ""
+    info.gname = "root" if gid == 0 else ""
+    info.mode = mode
+    info.mtime = mtime
+    return info
+
+def ar_header(name, size, mtime, mode=0o100644):
+    return ("%-16s%-12d%-6d%-6d%-8o%-10d`\n" % (name, mtime, 0, 0, mode, size)).encode('ascii')
+
+def write_member(out, name, data, mtime):
+    out.write(ar_header(name, len(data), mtime))
+    out.write(data)
+    if len(data) % 2:
+        out.write(b"\n")
+
+def with_parents(entries):
+    seen = set()
+    result = []
+    for src, dest, uid, gid, mode in entries:
+        name = tar_name(dest)
+        parent = os.path.dirname(name)
+        missing = []
+        while parent not in seen and parent != ".":
+            missing.insert(0, parent)
+            parent = os.path.dirname(parent)
+        for a in missing:
+            seen.add(a)
+            result.append((None, a, 0, 0, 0o755))
+        if name not in seen:
+            seen.add(name)
+            result.append((src, name, uid, gid, mode))
+    return [ (None, ".", 0, 0, 0o755) ] + result
+
+@ib.buildcmd()
+@ib.buildcmd_name("deb.build")
+class build(object):
+    def run(self, s, output, control, entries, conffiles=None, threads=None):
+        mtime = int(os.getenv('SOURCE_DATE_EPOCH', '%d' % time.time()))
+        entries = with_parents(entries)
+        control = dict(control)
+        if "Installed-Size" not in control:
+            size = sum(os.lstat(src).st_size for src, dest, uid, gid, mode in entries
+                    if src and not os.path.islink(src))
+            control["Installed-Size"] = "%d" % ((size + 1023) // 1024)
+        s.debug("Writing %s (%s %s, %d entries)", output, control["Package"], control["Version"], len(entries))
+
+        members = [ ("control", control_text(control).encode('utf-8'), 0o644) ]
+        if conffiles:
+            members.append(("conffiles", "".join(a + "\n" for a in conffiles).encode('utf-8'), 0o644))
+        control_tar = io.BytesIO()
+        with tarfile.open(fileobj=control_tar, mode="w:gz", format=tarfile.GNU_FORMAT) as tar:
+            info = tarinfo(".", 0, 0, 0o755, mtime)
+            info.type = tarfile.DIRTYPE
+            tar.addfile(info)
+            for name, data, mode in members:
+                info = tarinfo("./" + name, 0, 0, mode, mtime)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+
+        with open(output + ".tmp", "wb") as out:
+            out.write(b"!<arch>\n")
+            write_member(out, "debian-binary", b"2.0\n", mtime)
+            write_member(out, "control.tar.gz", control_tar.getvalue(), mtime)
+            header = out.tell()
+            out.write(ar_header("data.tar.gz", 0, mtime))
+            start = out.tell()
+            gz = ib.compress.parallel_gzip(out, threads)
+            with tarfile.open(fileobj=gz, mode="w|", format=tarfile.GNU_FORMAT) as tar:
+                for src, name, uid, gid, mode in entries:
+                    if src is None:
+                        info = tarinfo(name, uid, gid, mode, mtime)
+                        info.type = tarfile.DIRTYPE
+                        tar.addfile(info)
+                        continue
+                    st = os.lstat(src)
+                    info = tarinfo(name, uid, gid, mode, int(st.st_mtime))
+                    if stat.S_ISLNK(st.st_mode):
+                        info.type = tarfile.SYMTYPE
+                        info.linkname = os.readlink(src)
+                        info.mode = 0o777
+                        tar.addfile(info)
+                    else:
+                        info.size = st.st_size
+                        with open(src, "rb") as f:
+                            tar.addfile(info, f)
+            gz.close()
+            size = out.tell() - start
+            if size % 2:
+                out.write(b"\n")
+            out.seek(header)
+            out.write(ar_header("data.tar.gz", size, mtime))
+        os.rename(output + ".tmp", output)
+        self.output = output
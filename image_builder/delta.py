@@ -0,0 +1,169 @@
+import image_builder as ib
+import hashlib
+import lzma
+import os
+import struct
+import sys
+
+MAGIC = b"IBDELTA1"
+BLOCK_SIZE = 4096
+HEADER = struct.Struct("<IQQ")
+OP = struct.Struct("<BQQ")
+END, COPY, DATA, ZERO = 0, 1, 2, 3
+MAX_DATA_BLOCKS = 256
+
+# Records are written in destination order and together cover every block of
+# the new image exactly once:
+#   COPY dst count src  - blocks taken from the old image
+#   DATA dst count      - followed by count blocks of literal data
+#   ZERO dst count      - blocks of zeros
+#   END  0 0            - followed by the sha256 of the new image
+
+def blocks(path, block_size):
+    pending = b""
+    for chunk in ib.file.read_sparse(path):
+        if pending:
+            chunk = pending + chunk
+            pending = b""
+        end = len(chunk) - len(chunk) % block_size
+        for offset in range(0, end, block_size):
+            yield chunk[offset:offset + block_size]
+        pending = chunk[end:]
+    if pending:
+        yield pending
+
+def block_hash(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+def index(path, block_size):
+    result = {}
+    zero = bytes(block_size)
+    for i, data in enumerate(blocks(path, block_size)):
+        if len(data) == block_size and data != zero:
+            result.setdefault(block_hash(data), i)
+    return result
+
+class writer(object):
+    def __init__(self, out, block_size):
+        self.out = out
+        self.block_size = block_size
+        self.op = None
+        self.dst = 0
+        self.count = 0
+        self.src = 0
+        self.data = []
+        self.stats = { COPY: 0, DATA: 0, ZERO: 0 }
+
+    def add(self, op, dst, src=0, data=None):
+        contiguous = (op == self.op and dst == self.dst + self.count and
+                (op != COPY or src == self.src + self.count) and
+                (op != DATA or self.count < MAX_DATA_BLOCKS))
+        if not contiguous:
+            self.flush()
+            self.op, self.dst, self.src = op, dst, src
+        self.count += 1
+        if data is not None:
+            self.data.append(data)
+
+    def flush(self):
+        if self.op is None:
+            return
+        self.stats[self.op] += self.count
+        self.out.write(OP.pack(self.op, self.dst, self.count))
+        if self.op == COPY:
+            self.out.write(struct.pack("<Q", self.src))
+        elif self.op == DATA:
+            data = b"".join(self.data)
+            self.out.write(struct.pack("<Q", len(data)))
+            self.out.write(data)
+        self.op, self.count, self.data = None, 0, []
+
+@ib.buildcmd()
+@ib.buildcmd_name("delta.create")
+class create(object):
+    def run(self, s, old, new, output, block_size=BLOCK_SIZE):
+        s.debug("Indexing %s", old)
+        known = index(old, block_size)
+        zero = bytes(block_size)
+        digest = hashlib.sha256()
+        with open(old, "rb") as fold, lzma.open(output + ".tmp", "wb") as out:
+            out.write(MAGIC)
+            out.write(HEADER.pack(block_size, os.stat(old).st_size, os.stat(new).st_size))
+            w = writer(out, block_size)
+            for i, data in enumerate(blocks(new, block_size)):
+                digest.update(data)
+                if data == zero:
+                    w.add(ZERO, i)
+                    continue
+                src = known.get(block_hash(data)) if len(data) == block_size else None
+                if src is not None and os.pread(fold.fileno(), block_size, src * block_size) == data:
+                    w.add(COPY, i, src)
+                else:
+                    w.add(DATA, i, data=data)
+            w.flush()
+            out.write(OP.pack(END, 0, 0))
+            out.write(digest.digest())
+        os.rename(output + ".tmp", output)
+        self.stats = { "copy": w.stats[COPY], "data": w.stats[DATA], "zero": w.stats[ZERO] }
+        s.info("Delta %s: %d blocks copied, %d literal, %d zero (%d bytes)", output,
+                w.stats[COPY], w.stats[DATA], w.stats[ZERO], os.stat(output).st_size)
+
+def read_exact(f, n):
+    data = f.read(n)
+    if len(data) != n:
+        raise ib.BuilderError("Truncated delta")
+    return data
+
+@ib.buildcmd()
+@ib.buildcmd_name("delta.apply")
+class apply(object):
+    def run(self, s, old, delta, output):
+        digest = hashlib.sha256()
+        with lzma.open(delta, "rb") as f, open(old, "rb") as fold, open(output + ".tmp", "wb") as out:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ib.BuilderError("%s is not an image delta" % delta)
+            block_size, old_size, new_size = HEADER.unpack(read_exact(f, HEADER.size))
+            if os.stat(old).st_size != old_size:
+                raise ib.BuilderError("%s is %d bytes, delta expects %d" % (old, os.stat(old).st_size, old_size))
+            out.truncate(new_size)
+            zero = bytes(ib.file.SPARSE_CHUNK)
+            while True:
+                op, dst, count = OP.unpack(read_exact(f, OP.size))
+                if op == END:
+                    break
+                offset = dst * block_size
+                if op == COPY:
+                    src = struct.unpack("<Q", read_exact(f, 8))[0] * block_size
+                    remaining = min(count * block_size, new_size - offset)
+                    while remaining > 0:
+                        data = os.pread(fold.fileno(), min(remaining, ib.file.SPARSE_CHUNK), src)
+                        if not data:
+                            raise ib.BuilderError("Short read from %s at %d" % (old, src))
+                        os.pwrite(out.fileno(), data, offset)
+                        digest.update(data)
+                        src += len(data)
+                        offset += len(data)
+                        remaining -= len(data)
+                elif op == DATA:
+                    data = read_exact(f, struct.unpack("<Q", read_exact(f, 8))[0])
+                    os.pwrite(out.fileno(), data, offset)
+                    digest.update(data)
+                elif op == ZERO:
+                    remaining = min(count * block_size, new_size - offset)
+                    while remaining > 0:
+                        n = min(remaining, len(zero))
+                        digest.update(zero[:n])
+                        remaining -= n
+                else:
+                    raise ib.BuilderError("Unknown delta record %d" % op)
+            if read_exact(f, 32) != digest.digest():
+                raise ib.BuilderError("Checksum mismatch applying %s" % delta)
+        os.rename(output + ".tmp", output)
+
+def main(argv):
+    if len(argv) == 5 and argv[1] in ("create", "apply"):
+        with ib.builder() as s:
+            (create if argv[1] == "create" else apply)(s, argv[2], argv[3], argv[4])
+        return 0
+    print("Usage: %s create <old> <new> <delta> | apply <old> <delta> <output>" % " ".join(argv[:1]), file=sys.stderr)
+    return 2
@@ -1,6 +1,87 @@
 import image_builder as ib
+import concurrent.futures
 import shutil
+import errno
+import fcntl
+import fnmatch
+import hashlib
 import os
+import stat
+import threading
+
+SPARSE_CHUNK = 1024*1024
+
+def extents(path):
+    with open(path, "rb") as f:
+        fd = f.fileno()
+        size = os.fstat(fd).st_size
+        offset = 0
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    return
+                if e.errno == errno.EINVAL:
+                    yield (offset, size - offset)
+                    return
+                raise
+            end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+            yield (start, end - start)
+            offset = end
+
+def read_sparse(path, chunk=SPARSE_CHUNK):
+    zeros = bytes(chunk)
+    size = os.stat(path).st_size
+    offset = 0
+    with open(path, "rb") as f:
+        for start, length in list(extents(path)) + [(size, 0)]:
+            while offset < start:
+                n = min(chunk, start - offset)
+                yield zeros[:n] if n < chunk else zeros
+                offset += n
+            end = start + length
+            while offset < end:
+                data = os.pread(f.fileno(), min(chunk, end - offset), offset)
+                if not data:
+                    raise ib.BuilderError("Short read from %s at %d" % (path, offset))
+                yield data
+                offset += len(data)
+
+FICLONE = 0x40049409
+
+# Copies the contents of one file to another, sharing extents when the
+# filesystem can reflink and falling back to an in-kernel copy otherwise.
+# Returns "reflink" or "copy".
+def clone_file(from_path, to_path, mode=0o644):
+    with open(from_path, "rb") as fin:
+        fd = os.open(to_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        try:
+            try:
+                fcntl.ioctl(fd, FICLONE, fin.fileno())
+                return "reflink"
+            except OSError:
+                pass
+            remaining = os.fstat(fin.fileno()).st_size
+            offset = 0
+            while remaining > 0:
+                try:
+                    n = os.copy_file_range(fin.fileno(), fd, remaining, offset, offset)
+                except OSError as e:
+                    if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+                        raise
+                    fin.seek(offset)
+                    with os.fdopen(os.dup(fd), "wb") as fout:
+                        fout.seek(offset)
+                        shutil.copyfileobj(fin, fout)
+                    break
+                if n == 0:
+                    break
+                offset += n
+                remaining -= n
+            return "copy"
+        finally:
+            os.close(fd)
 
 @ib.buildcmd()
 @ib.buildcmd_name("file.copy")
@@ -71,8 +152,10 @@ class chown(object):
 @ib.buildcmd_name("file.mkdir")
 @ib.buildcmd_flatten()
 class mkdir(object):
-    def run(self, s, path):
+    def run(self, s, path, exist_ok=False):
         s.debug("Creating directory %s", path)
+        if exist_ok and os.path.isdir(path):
+            return
         os.mkdir(path)
 
 @ib.buildcmd()
@@ -98,3 +181,191 @@ class copy_r(object):
     def run(self, s, from_path, to_path, **kwargs):
         s.debug("Copying %s to %s", from_path, to_path)
         shutil.copytree(from_path, to_path, **kwargs)
+
+@ib.buildcmd()
+@ib.buildcmd_name("file.copy_sparse")
+@ib.buildcmd_flatten()
+class copy_sparse(object):
+    def run(self, s, from_path, to_path, offset=0):
+        s.debug("Copying allocated extents of %s to %s (offset %d)", from_path, to_path, offset)
+        size = os.stat(from_path).st_size
+        self.copied = 0
+        flags = os.O_WRONLY | os.O_CREAT
+        if offset == 0:
+            flags |= os.O_TRUNC
+        fdout = os.open(to_path, flags, 0o644)
+        try:
+            with open(from_path, "rb") as fin:
+                for start, length in extents(from_path):
+                    src, dst = start, offset + start
+                    while length > 0:
+                        n = os.copy_file_range(fin.fileno(), fdout, length, src, dst)
+                        if n == 0:
+                            raise ib.BuilderError("Short copy from %s at %d" % (from_path, src))
+                        src += n
+                        dst += n
+                        length -= n
+                        self.copied += n
+            if os.fstat(fdout).st_size < offset + size:
+                os.ftruncate(fdout, offset + size)
+        finally:
+            os.close(fdout)
+
+def matches(path, patterns):
+    return any(fnmatch.fnmatchcase(path, p) for p in patterns)
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(SPARSE_CHUNK), b""):
+            h.update(chunk)
+    return h.digest()
+
+def same_file(src, dst, st, compare):
+    try:
+        dst_st = os.lstat(dst)
+    except FileNotFoundError:
+        return False
+    if not stat.S_ISREG(dst_st.st_mode) or dst_st.st_size != st.st_size:
+        return False
+    if compare == "hash":
+        return file_digest(src) == file_digest(dst)
+    return dst_st.st_mtime_ns == st.st_mtime_ns
+
+def copy_metadata(src, dst, st, metadata):
+    if metadata:
+        os.chown(dst, st.st_uid, st.st_gid, follow_symlinks=False)
+        if not stat.S_ISLNK(st.st_mode):
+            os.chmod(dst, stat.S_IMODE(st.st_mode))
+        # after chown, which drops security.capability
+        for name in os.listxattr(src, follow_symlinks=False):
+            try:
+                os.setxattr(dst, name, os.getxattr(src, name, follow_symlinks=False), follow_symlinks=False)
+            except OSError as e:
+                if e.errno not in (errno.ENOTSUP, errno.EPERM):
+                    raise
+    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+
+def replace_path(dst):
+    try:
+        if os.path.isdir(dst) and not os.path.islink(dst):
+            shutil.rmtree(dst)
+        else:
+            os.unlink(dst)
+    except FileNotFoundError:
+        pass
+
+@ib.buildcmd()
+@ib.buildcmd_name("file.sync_tree")
+class sync_tree(object):
+    def run(self, s, from_path, to_path, include=None, exclude=(), compare="mtime", metadata=True, jobs=None):
+        if jobs is None:
+            jobs = ib.scheduler.default_jobs()
+        self.copied = self.reflinked = self.skipped = self.removed = 0
+        lock = threading.Lock()
+        files = []
+        links = []
+        dirs = []
+        inodes = {}
+
+        def account(kind, size):
+            with lock:
+                setattr(self, kind, getattr(self, kind) + size)
+
+        def sync_file(rel, st):
+            src = os.path.join(from_path, rel)
+            dst = os.path.join(to_path, rel)
+            if same_file(src, dst, st, compare):
+                account("skipped", st.st_size)
+            else:
+                replace_path(dst)
+                kind = clone_file(src, dst, 0o600)
+                account("reflinked" if kind == "reflink" else "copied", st.st_size)
+            copy_metadata(src, dst, st, metadata)
+
+        # Destination entries missing from the source go, unless the filters
+        # would have kept them out of the sync in the first place. Returns
+        # whether anything under rel was kept.
+        def prune(rel):
+            dst = os.path.join(to_path, rel)
+            if matches(rel, exclude):
+                return True
+            st = os.lstat(dst)
+            if stat.S_ISDIR(st.st_mode):
+                kept = False
+                for name in os.listdir(dst):
+                    kept = prune(os.path.join(rel, name)) or kept
+                if not kept:
+                    os.rmdir(dst)
+                return kept
+            if include is not None and not matches(rel, include):
+                return True
+            os.unlink(dst)
+            self.removed += st.st_size
+            return False
+
+        if not os.path.isdir(to_path):
+            os.makedirs(to_path)
+        pending = [ "" ]
+        while pending:
+            rel = pending.pop()
+            dirs.append((rel, os.lstat(os.path.join(from_path, rel) if rel else from_path)))
+            with os.scandir(os.path.join(from_path, rel) if rel else from_path) as it:
+                entries = sorted(it, key=lambda e: e.name)
+            for entry in entries:
+                path = os.path.join(rel, entry.name)
+                if matches(path, exclude):
+                    continue
+                st = entry.stat(follow_symlinks=False)
+                src = os.path.join(from_path, path)
+                dst = os.path.join(to_path, path)
+                if stat.S_ISDIR(st.st_mode):
+                    if not os.path.isdir(dst) or os.path.islink(dst):
+                        replace_path(dst)
+                        os.mkdir(dst, 0o700)
+                    pending.append(path)
+                    continue
+                if include is not None and not matches(path, include):
+                    continue
+                if st.st_nlink > 1 and not stat.S_ISDIR(st.st_mode):
+                    key = (st.st_dev, st.st_ino)
+                    if key in inodes:
+                        links.append((inodes[key], path))
+                        continue
+                    inodes[key] = path
+                if stat.S_ISREG(st.st_mode):
+                    files.append((path, st))
+                elif stat.S_ISLNK(st.st_mode):
+                    target = os.readlink(src)
+                    if not (os.path.islink(dst) and os.readlink(dst) == target):
+                        replace_path(dst)
+                        os.symlink(target, dst)
+                    copy_metadata(src, dst, st, metadata)
+                elif stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode) or stat.S_ISFIFO(st.st_mode):
+                    replace_path(dst)
+                    os.mknod(dst, st.st_mode, st.st_rdev)
+                    copy_metadata(src, dst, st, metadata)
+            names = { e.name for e in entries }
+            for name in os.listdir(os.path.join(to_path, rel) if rel else to_path):
+                if name not in names:
+                    prune(os.path.join(rel, name))
+
+        s.debug("Syncing %d files from %s to %s on %d workers", len(files), from_path, to_path, jobs)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            for f in [ pool.submit(sync_file, path, st) for path, st in files ]:
+                f.result()
+        for first, path in links:
+            dst = os.path.join(to_path, path)
+            replace_path(dst)
+            try:
+                os.link(os.path.join(to_path, first), dst, follow_symlinks=False)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                st = os.lstat(os.path.join(from_path, path))
+                sync_file(path, st)
+        for rel, st in reversed(dirs):
+            copy_metadata(os.path.join(from_path, rel) if rel else from_path,
+                    os.path.join(to_path, rel) if rel else to_path, st, metadata)
+        s.info("Synced %s to %s: %d bytes copied, %d reflinked, %d unchanged, %d removed", from_path, to_path,
+                self.copied, self.reflinked, self.skipped, self.removed)
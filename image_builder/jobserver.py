@@ -0,0 +1,69 @@
+import image_builder as ib
+import os
+import re
+import threading
+
+JOB_MEMORY = 512 * 1024 * 1024
+
+def mem_available():
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def default_jobs():
+    jobs = int(os.getenv('BUILD_MAKE_JOBS', '0'))
+    if jobs > 0:
+        return jobs
+    jobs = os.cpu_count() or 1
+    mem = mem_available()
+    if mem is not None:
+        jobs = min(jobs, mem // JOB_MEMORY)
+    return max(1, jobs)
+
+class _Jobserver(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.fds = None
+        self.jobs = None
+
+    def get(self):
+        with self.lock:
+            if self.fds is None:
+                self.jobs = default_jobs()
+                self.fds = os.pipe()
+                os.write(self.fds[1], b"+" * self.jobs)
+            return self.fds
+
+    def acquire(self):
+        return os.read(self.get()[0], 1)
+
+    def release(self, token):
+        os.write(self.get()[1], token)
+
+    def makeflags(self):
+        r, w = self.get()
+        return " -j%d --jobserver-auth=%d,%d" % (self.jobs, r, w)
+
+jobserver = _Jobserver()
+
+# Every make holds one token for its implicit job slot while it runs, so the
+# pipe holds exactly as many tokens as jobs we allow across all makes.
+@ib.buildcmd()
+@ib.buildcmd_name("make")
+class make(object):
+    def run(self, s, args, **kwargs):
+        args = [ a for a in args if not re.match(r"^-j[0-9]*$", a) ]
+        env = dict(kwargs.pop('env', None) or os.environ)
+        env['MAKEFLAGS'] = jobserver.makeflags()
+        s.debug("Waiting for a job slot (%d total)", jobserver.jobs)
+        token = jobserver.acquire()
+        try:
+            ib.check_subprocess(s, [ 'make' ] + list(args), env=env,
+                    pass_fds=jobserver.get(), **kwargs)
+        finally:
+            jobserver.release(token)
@@ -0,0 +1,241 @@
+import image_builder as ib
+import concurrent.futures
+import itertools
+import json
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+
+UMOUNT_RETRIES = 5
+TEARDOWN_JOBS = int(os.getenv('BUILD_TEARDOWN_JOBS', '8'))
+
+# Each process appends to <state>/journal/<pid>-<start time> as it acquires
+# and releases resources:
+#   {"pid": ..., "start": ...}                          - header
+#   {"op": "+", "id": n, "kind": k, "path": p, "uses": u}
+#   {"op": "-", "id": n}
+# The file is removed once nothing is held, so anything left behind by a dead
+# process is exactly what it leaked.
+
+def directory():
+    path = os.path.join(ib.loopback.state_dir(), "journal")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def unescape(field):
+    return os.fsdecode(re.sub(rb"\\([0-7]{3})", lambda m: bytes([ int(m.group(1), 8) ]), field))
+
+def mountpoints():
+    with open("/proc/self/mountinfo", "rb") as f:
+        return [ unescape(line.split()[4]) for line in f ]
+
+def within(path, parent):
+    if path == parent or path.startswith(parent.rstrip("/") + "/"):
+        return True
+    # /dev/loop3p1 lives on /dev/loop3
+    return parent.startswith("/dev/") and path.startswith(parent + "p")
+
+def mounts_under(path):
+    return [ m for m in mountpoints() if within(m, path) ]
+
+class _Journal(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.held = set()
+        self.fd = None
+        self.pid = None
+        self.start = None
+
+    def path(self):
+        return os.path.join(directory(), "%d-%s" % (self.pid, self.start))
+
+    def write(self, entry):
+        if self.fd is None or self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.start = ib.loopback.start_time(self.pid)
+            self.held = set()
+            self.fd = os.open(self.path(), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            os.write(self.fd, (json.dumps({ "pid": self.pid, "start": self.start }) + "\n").encode())
+        os.write(self.fd, (json.dumps(entry) + "\n").encode())
+
+    def acquire(self, o, kind, path, uses=None):
+        if uses is not None and not uses.startswith("/"):
+            uses = None
+        with self.lock:
+            entry = { "op": "+", "id": next(self.ids), "kind": kind, "path": path, "uses": uses }
+            self.write(entry)
+            self.held.add(entry["id"])
+        if not hasattr(o, 'journal_entries'):
+            o.journal_entries = []
+        o.journal_entries.append(entry)
+
+    def release(self, o):
+        with self.lock:
+            for entry in getattr(o, 'journal_entries', []):
+                if entry["id"] in self.held and self.pid == os.getpid():
+                    self.write({ "op": "-", "id": entry["id"] })
+                    self.held.discard(entry["id"])
+            if self.fd is not None and not self.held:
+                os.close(self.fd)
+                os.unlink(self.path())
+                self.fd = None
+
+journal = _Journal()
+
+def acquire(o, kind, path, uses=None):
+    journal.acquire(o, kind, path, uses)
+
+def release(o):
+    journal.release(o)
+
+def read(path):
+    with open(path, "r") as f:
+        header = json.loads(f.readline())
+        held = {}
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # torn final write from a killed process
+                continue
+            if entry["op"] == "+":
+                held[entry["id"]] = entry
+            else:
+                held.pop(entry["id"], None)
+    return header, [ held[i] for i in sorted(held) ]
+
+def journals():
+    d = directory()
+    for name in sorted(os.listdir(d)):
+        try:
+            header, entries = read(os.path.join(d, name))
+        except (OSError, ValueError, KeyError):
+            continue
+        alive = ib.loopback.start_time(header["pid"]) == header["start"]
+        yield os.path.join(d, name), header["pid"], alive, entries
+
+def umount(s, path):
+    for attempt in range(UMOUNT_RETRIES):
+        ret = ib.subprocess(s, [ 'umount', path ]).returncode
+        if ret == 0 or path not in mountpoints():
+            return 0
+        s.debug("%s is busy, retrying", path)
+        time.sleep(0.2 * (attempt + 1))
+    s.warning("%s is still busy, detaching lazily", path)
+    return ib.subprocess(s, [ 'umount', '-l', path ]).returncode
+
+def remove_tree(s, path):
+    busy = mounts_under(path)
+    if busy:
+        raise ib.BuilderError("Not removing %s, %s still mounted" % (path, ", ".join(busy)))
+    shutil.rmtree(path)
+
+def undo(s, entry):
+    kind, path = entry["kind"], entry["path"]
+    if kind == "mount":
+        if path in mountpoints() and umount(s, path) != 0:
+            raise ib.BuilderError("Couldn't unmount %s" % path)
+    elif kind == "loop":
+        if ib.loopback.backing_file(path) == entry["uses"] and ib.loopback.pool.detach(s, path) != 0:
+            raise ib.BuilderError("Couldn't detach %s" % path)
+    elif kind == "tree":
+        if os.path.lexists(path):
+            remove_tree(s, path)
+    elif kind == "subvolume":
+        if os.path.lexists(path):
+            ib.check_subprocess(s, [ 'btrfs', 'subvolume', 'delete', path ])
+    else:
+        raise ib.BuilderError("Unknown journal entry %s" % kind)
+
+# A cleanup has to wait for a later one if anything the later one holds or
+# uses lives inside what it is about to tear down. Cleanups without journal
+# entries are ordered against everything.
+def ordered(later, earlier):
+    a = getattr(later, 'journal_entries', None)
+    b = getattr(earlier, 'journal_entries', None)
+    if not a or not b:
+        return True
+    for e in b:
+        for l in a:
+            if within(l["path"], e["path"]) or (l["uses"] and within(l["uses"], e["path"])):
+                return True
+    return False
+
+def teardown(s, callbacks, jobs=None):
+    if jobs is None:
+        jobs = TEARDOWN_JOBS
+    waits = { i: { j for j in range(i) if ordered(callbacks[j], callbacks[i]) } for i in range(len(callbacks)) }
+    pending = dict(waits)
+    done = set()
+    failed = set()
+    failure = None
+    running = {}
+
+    def cleanup(s, o):
+        s.info("Cleanup handler for %s", s.buildcmd_name(o))
+        o.cleanup(s)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        while pending or running:
+            for i in [ i for i, w in pending.items() if w <= done | failed ]:
+                del pending[i]
+                if waits[i] & failed:
+                    s.warning("Skipping cleanup handler for %s, it depends on one that failed", s.buildcmd_name(callbacks[i]))
+                    failed.add(i)
+                else:
+                    running[pool.submit(cleanup, s.fork(), callbacks[i])] = i
+            if not running:
+                continue
+            finished, _ = concurrent.futures.wait(running,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+            for f in finished:
+                i = running.pop(f)
+                if f.exception() is not None:
+                    s.error("Cleanup handler for %s failed: %s", s.buildcmd_name(callbacks[i]), f.exception())
+                    failed.add(i)
+                    if failure is None:
+                        failure = f.exception()
+                else:
+                    done.add(i)
+    if failure is not None:
+        raise failure
+
+class leftover(object):
+    def __init__(self, entry):
+        self.entry = entry
+        self.journal_entries = [ entry ]
+        self.buildcmd_name = "%s %s" % (entry["kind"], entry["path"])
+
+    def cleanup(self, s):
+        undo(s, self.entry)
+
+@ib.buildcmd()
+@ib.buildcmd_name("journal.recover")
+class recover(object):
+    def run(self, s):
+        self.recovered = 0
+        for path, pid, alive, entries in journals():
+            if alive or pid == os.getpid():
+                continue
+            s.info("Replaying journal of dead builder %d (%d resources)", pid, len(entries))
+            teardown(s, [ leftover(e) for e in reversed(entries) ])
+            os.unlink(path)
+            self.recovered += len(entries)
+
+def main(argv):
+    if len(argv) == 2 and argv[1] == "show":
+        for path, pid, alive, entries in journals():
+            print("%d (%s)" % (pid, "running" if alive else "dead"))
+            for e in entries:
+                print("    %s %s%s" % (e["kind"], e["path"], " (%s)" % e["uses"] if e["uses"] else ""))
+        return 0
+    if len(argv) == 2 and argv[1] == "recover":
+        with ib.builder() as s:
+            recover(s)
+        return 0
+    print("Usage: %s show | recover" % " ".join(argv[:1]), file=sys.stderr)
+    return 2
@@ -0,0 +1,108 @@
+import image_builder as ib
+import atexit
+import colorlog
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+
+LOG_LEVEL = os.getenv('BUILD_LOG_LEVEL', 'DEBUG').upper()
+LOG_JSON = os.getenv('BUILD_LOG_JSON')
+INDENT = "    "
+
+# Records go onto the queue as they are created; the listener thread does the
+# formatting and writing. The builder attaches "depth" and "buildcmd" to each
+# record rather than baking the indent into the message. The message and any
+# traceback are rendered here, as the arguments may change before the
+# listener gets to them.
+class queue_handler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+class console_formatter(colorlog.ColoredFormatter):
+    def format(self, record):
+        record.indent = INDENT * getattr(record, 'depth', 0)
+        return super(console_formatter, self).format(record)
+
+class json_handler(logging.Handler):
+    def __init__(self, path):
+        super(json_handler, self).__init__()
+        self.stream = open(path, "a")
+
+    def emit(self, record):
+        try:
+            o = getattr(record, 'buildcmd', None)
+            entry = {
+                "time": record.created,
+                "level": record.levelname,
+                "thread": record.threadName,
+                "depth": getattr(record, 'depth', 0),
+                "buildcmd": getattr(o, 'buildcmd_name', o.__class__.__name__) if o is not None else None,
+                "message": record.getMessage(),
+            }
+            if record.exc_text:
+                entry["exception"] = record.exc_text
+            self.stream.write(json.dumps(entry) + "\n")
+            self.stream.flush()
+        except Exception:
+            self.handleError(record)
+
+class _Pipeline(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.listener = None
+
+    def setup(self, logger):
+        with self.lock:
+            if self.listener is not None:
+                return
+            console = logging.StreamHandler()
+            console.setFormatter(console_formatter(
+                "%(log_color)s%(levelname)-8s%(reset)s %(indent)s%(message)s",
+                datefmt=None,
+                reset=True,
+                log_colors={
+                    'DEBUG':    'cyan',
+                    'INFO':     'green',
+                    'WARNING':  'yellow',
+                    'ERROR':    'red',
+                    'CRITICAL': 'red,bg_white',
+                },
+                style='%'))
+            handlers = [ console ]
+            if LOG_JSON:
+                handlers.append(json_handler(LOG_JSON))
+            self.listener = logging.handlers.QueueListener(self.queue, *handlers)
+            self.listener.start()
+            logger.addHandler(queue_handler(self.queue))
+            logger.setLevel(LOG_LEVEL)
+            atexit.register(self.stop)
+
+    def flush(self):
+        if self.listener is not None:
+            self.queue.join()
+
+    def stop(self):
+        with self.lock:
+            if self.listener is not None:
+                self.listener.stop()
+                self.listener = None
+
+pipeline = _Pipeline()
+
+def setup(logger):
+    pipeline.setup(logger)
+
+def flush():
+    pipeline.flush()
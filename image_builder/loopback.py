@@ -1,31 +1,163 @@
 import image_builder as ib
 import subprocess
+import fcntl
 import os
 import sys
+import tempfile
+import threading
+import time
+
+LOOP_CTL_GET_FREE = 0x4C82
+LOOP_CONTROL = os.getenv('LOOP_CONTROL', '/dev/loop-control')
+ATTACH_RETRIES = 5
+
+def state_dir():
+    path = os.getenv('IMAGE_BUILDER_STATE', '/run/image_builder')
+    for d in [ path, os.path.join(tempfile.gettempdir(), "image_builder-%d" % os.getuid()) ]:
+        try:
+            os.makedirs(os.path.join(d, "loop"), exist_ok=True)
+            if os.access(d, os.W_OK):
+                return d
+        except OSError:
+            pass
+    raise ib.BuilderError("No writable state directory for loop devices (tried %s)" % path)
+
+def start_time(pid):
+    try:
+        with open("/proc/%d/stat" % pid, "r") as f:
+            return f.read().rsplit(")", 1)[1].split()[19]
+    except (OSError, IndexError):
+        return None
+
+def backing_file(device):
+    try:
+        with open("/sys/block/%s/loop/backing_file" % os.path.basename(device), "r") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+# Every device we attach is recorded in <state>/loop/<name> with the owning pid
+# and its start time, so a later run can tell a live owner from a recycled pid.
+class _Pool(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.directory = None
+        self.free = []
+        self.reclaimed = False
+
+    def registry(self):
+        if self.directory is None:
+            self.directory = state_dir()
+        return os.path.join(self.directory, "loop")
+
+    def locked(self):
+        fd = os.open(os.path.join(os.path.dirname(self.registry()), "loop.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    def unlock(self, fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def record(self, device, image):
+        pid = os.getpid()
+        with open(os.path.join(self.registry(), os.path.basename(device)), "w") as f:
+            print("%d %s %s" % (pid, start_time(pid), os.path.abspath(image)), file=f)
+
+    def forget(self, device):
+        try:
+            os.unlink(os.path.join(self.registry(), os.path.basename(device)))
+        except FileNotFoundError:
+            pass
+
+    def reclaim(self, s):
+        for name in sorted(os.listdir(self.registry())):
+            try:
+                with open(os.path.join(self.registry(), name), "r") as f:
+                    pid, started, image = f.read().strip().split(" ", 2)
+            except (OSError, ValueError):
+                continue
+            if start_time(int(pid)) == started:
+                continue
+            device = os.path.join("/dev", name)
+            if backing_file(device) == image:
+                s.info("Reclaiming %s left attached to %s by dead builder %s", device, image, pid)
+                if ib.subprocess(s, [ 'losetup', '-d', device ]).returncode != 0:
+                    s.warning("Couldn't detach %s", device)
+                    continue
+            self.forget(device)
+
+    def candidate(self):
+        while self.free:
+            device = self.free.pop()
+            if os.path.exists(device) and backing_file(device) is None:
+                return device
+        if not os.path.exists(LOOP_CONTROL):
+            return None
+        fd = os.open(LOOP_CONTROL, os.O_RDWR)
+        try:
+            return "/dev/loop%d" % fcntl.ioctl(fd, LOOP_CTL_GET_FREE)
+        finally:
+            os.close(fd)
+
+    def attach(self, s, image, args):
+        with self.lock:
+            fd = self.locked()
+            try:
+                if not self.reclaimed:
+                    self.reclaimed = True
+                    self.reclaim(s)
+                for attempt in range(ATTACH_RETRIES):
+                    device = self.candidate()
+                    if device is None:
+                        with subprocess.Popen([ 'losetup', '--show', '--find' ] + args + [ image ],
+                                stdout=subprocess.PIPE) as proc:
+                            device = proc.stdout.readline().decode('utf-8').strip()
+                        if proc.returncode != 0 or not os.path.exists(device):
+                            raise ib.BuilderError("Can't find loopback device: %s" % device)
+                    elif ib.subprocess(s, [ 'losetup' ] + args + [ device, image ]).returncode != 0:
+                        # somebody outside the pool grabbed it first
+                        s.debug("Attaching %s failed, retrying", device)
+                        time.sleep(0.1 * (attempt + 1))
+                        continue
+                    self.record(device, image)
+                    return device
+            finally:
+                self.unlock(fd)
+        raise ib.BuilderError("Couldn't attach %s after %d attempts" % (image, ATTACH_RETRIES))
+
+    def detach(self, s, device):
+        for attempt in range(ATTACH_RETRIES):
+            ret = ib.subprocess(s, [ 'losetup', '-d', device ]).returncode
+            if ret == 0:
+                break
+            time.sleep(0.1 * (attempt + 1))
+        with self.lock:
+            self.forget(device)
+            if ret == 0:
+                self.free.append(device)
+        return ret
+
+pool = _Pool()
 
 @ib.buildcmd()
 @ib.buildcmd_name("loopback.init")
 class init(object):
     def run(self, s, image, offset=0, size=-1, partscan=False):
         self.image = image
-        cmd = ['losetup', '--offset', '%d' % offset, '--show', '--find']
+        args = [ '--offset', '%d' % offset ]
         if partscan:
-            cmd = cmd + ['--partscan']
+            args = args + [ '--partscan' ]
         if size > 0:
-            cmd = cmd + ['--sizelimit', '%d' % size]
-        cmd = cmd + [self.image]
-
-        with subprocess.Popen(cmd, stdout=subprocess.PIPE) as proc:
-            lo = proc.stdout.readline().decode('utf-8')
-        lo = lo.replace("\r", "").replace("\n", "").lstrip().rstrip()
-        if os.path.exists(lo):
-            self.device = lo
-        else:
-            raise BuilderError("Can't find loopback device: %s" % lo)
+            args = args + [ '--sizelimit', '%d' % size ]
+        self.device = pool.attach(s, self.image, args)
+        ib.journal.acquire(self, "loop", self.device, os.path.realpath(self.image))
         s.debug("Using loopback device: %s", self.device)
 
     def cleanup(self, s):
         s.debug("Detaching loopback device: %s", self.device)
-        ret = ib.subprocess(s, ["losetup", "-d", self.device]).returncode
+        ret = pool.detach(s, self.device)
         if ret != 0:
             s.warning("losetup detach returned %d", ret)
+        else:
+            ib.journal.release(self)
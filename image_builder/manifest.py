@@ -0,0 +1,128 @@
+import image_builder as ib
+import concurrent.futures
+import hashlib
+import os
+import stat
+import struct
+import sys
+
+MAGIC = b"IBMANIF1"
+RECORD = struct.Struct("<HIIIQq32s")
+FIELDS = [ "mode", "uid", "gid", "size", "mtime", "digest" ]
+CHUNK = 1024 * 1024
+NO_DIGEST = b"\0" * 32
+
+def walk(root):
+    pending = [ b"" ]
+    root = os.fsencode(root)
+    while pending:
+        rel = pending.pop()
+        yield (rel or b"/"), os.lstat(root + rel)
+        with os.scandir(root + (rel or b"/")) as it:
+            for entry in it:
+                path = rel + b"/" + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(path)
+                else:
+                    yield path, entry.stat(follow_symlinks=False)
+
+def digest(root, path, st):
+    if stat.S_ISREG(st.st_mode):
+        h = hashlib.sha256()
+        with open(os.fsencode(root) + path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK), b""):
+                h.update(chunk)
+        return h.digest()
+    if stat.S_ISLNK(st.st_mode):
+        return hashlib.sha256(os.readlink(os.fsencode(root) + path)).digest()
+    return NO_DIGEST
+
+def record(path, st, digest):
+    size = st.st_rdev if stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode) else st.st_size
+    if stat.S_ISDIR(st.st_mode):
+        size = 0
+    return (path, st.st_mode, st.st_uid, st.st_gid, size, st.st_mtime_ns, digest)
+
+def pack(r):
+    return RECORD.pack(len(r[0]), *r[1:]) + r[0]
+
+def read(path):
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ib.BuilderError("%s is not a manifest" % path)
+        while True:
+            header = f.read(RECORD.size)
+            if not header:
+                return
+            fields = RECORD.unpack(header)
+            yield (f.read(fields[0]),) + fields[1:]
+
+def changes(old, new):
+    result = []
+    for i, name in enumerate(FIELDS, 1):
+        if old[i] != new[i]:
+            result.append(name)
+    return result
+
+# Both manifests are sorted by path, so a single merge pass finds every
+# addition, removal and modification.
+def diff(a, b, ignore=("mtime",)):
+    old = next(a, None)
+    new = next(b, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old[0] < new[0]):
+            yield "-", old[0], old, None, []
+            old = next(a, None)
+        elif old is None or new[0] < old[0]:
+            yield "+", new[0], None, new, []
+            new = next(b, None)
+        else:
+            fields = [ f for f in changes(old, new) if f not in ignore ]
+            if fields:
+                yield "M", old[0], old, new, fields
+            old = next(a, None)
+            new = next(b, None)
+
+def describe(r):
+    return "%06o %d:%d %d %s" % (r[1], r[2], r[3], r[4], r[6].hex()[:16])
+
+@ib.buildcmd()
+@ib.buildcmd_name("manifest.write")
+class write(object):
+    def run(self, s, root, output, jobs=None):
+        if jobs is None:
+            jobs = ib.scheduler.default_jobs()
+        entries = sorted(walk(root), key=lambda e: e[0])
+        s.debug("Hashing %d entries under %s on %d workers", len(entries), root, jobs)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            digests = pool.map(lambda e: digest(root, e[0], e[1]), entries, chunksize=64)
+            records = [ record(path, st, d) for (path, st), d in zip(entries, digests) ]
+        with open(output + ".tmp", "wb") as f:
+            f.write(MAGIC)
+            for r in records:
+                f.write(pack(r))
+        os.rename(output + ".tmp", output)
+        self.entries = len(records)
+
+def main(argv):
+    if len(argv) == 4 and argv[1] == "diff":
+        counts = { "+": 0, "-": 0, "M": 0 }
+        for op, path, old, new, fields in diff(read(argv[2]), read(argv[3])):
+            counts[op] += 1
+            path = os.fsdecode(path)
+            if op == "M":
+                print("M %s (%s) %s -> %s" % (path, ",".join(fields), describe(old), describe(new)))
+            else:
+                print("%s %s %s" % (op, path, describe(old or new)))
+        print("%d added, %d removed, %d modified" % (counts["+"], counts["-"], counts["M"]), file=sys.stderr)
+        return 1 if sum(counts.values()) else 0
+    if len(argv) == 3 and argv[1] == "show":
+        for r in read(argv[2]):
+            print("%s %s" % (describe(r), os.fsdecode(r[0])))
+        return 0
+    if len(argv) == 4 and argv[1] == "create":
+        with ib.builder() as s:
+            write(s, argv[2], argv[3])
+        return 0
+    print("Usage: %s diff <old> <new> | show <manifest> | create <root> <output>" % " ".join(argv[:1]), file=sys.stderr)
+    return 2
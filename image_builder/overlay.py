@@ -0,0 +1,100 @@
+import image_builder as ib
+import concurrent.futures
+import filecmp
+import fnmatch
+import os
+import stat
+
+# A rules file has one rule per line, first match wins:
+#   <pattern> <uid> <gid> <octal mode>
+#   <pattern> skip
+def rules(path):
+    result = []
+    with open(path, "r") as f:
+        for n, line in enumerate(f, 1):
+            fields = line.split("#", 1)[0].split()
+            if not fields:
+                continue
+            if fields[1:] == [ "skip" ]:
+                result.append((fields[0], None))
+            elif len(fields) == 4:
+                result.append((fields[0], (int(fields[1]), int(fields[2]), int(fields[3], 8))))
+            else:
+                raise ib.BuilderError("%s:%d: expected '<pattern> <uid> <gid> <mode>' or '<pattern> skip'" % (path, n))
+    return result
+
+def lookup(rules, path):
+    for pattern, attrs in rules:
+        if fnmatch.fnmatchcase(path, pattern):
+            return attrs
+    raise ib.BuilderError("No overlay rule matches %s" % path)
+
+# Files named <path>.<variant> are only installed, as <path>, when that
+# variant is requested; plain files only when no variant is.
+def plan(src, rules, variant=None, variants=()):
+    result = []
+    for dirpath, dirnames, filenames in os.walk(src):
+        dirnames.sort()
+        for name in sorted(filenames):
+            from_path = os.path.join(dirpath, name)
+            target = "/" + os.path.relpath(from_path, src)
+            base, ext = os.path.splitext(target)
+            if ext[1:] in variants:
+                if ext[1:] != variant:
+                    continue
+                target = base
+            elif variant is not None:
+                continue
+            attrs = lookup(rules, target)
+            if attrs is not None:
+                result.append((from_path, target) + attrs)
+    return result
+
+def unchanged(from_path, to_path, uid, gid, mode):
+    try:
+        st = os.lstat(to_path)
+    except FileNotFoundError:
+        return False
+    if (st.st_uid, st.st_gid) != (uid, gid):
+        return False
+    if os.path.islink(from_path):
+        return stat.S_ISLNK(st.st_mode) and os.readlink(from_path) == os.readlink(to_path)
+    return (stat.S_ISREG(st.st_mode) and stat.S_IMODE(st.st_mode) == mode and
+            st.st_size == os.stat(from_path).st_size and filecmp.cmp(from_path, to_path, shallow=False))
+
+def install(from_path, to_path, uid, gid, mode):
+    if unchanged(from_path, to_path, uid, gid, mode):
+        return "skipped"
+    tmp = "%s.overlay-%d" % (to_path, os.getpid())
+    if os.path.islink(from_path):
+        os.symlink(os.readlink(from_path), tmp)
+        method = "copy"
+    else:
+        method = ib.file.clone_file(from_path, tmp, mode)
+        os.chmod(tmp, mode)
+    os.chown(tmp, uid, gid, follow_symlinks=False)
+    os.replace(tmp, to_path)
+    return method
+
+@ib.buildcmd()
+@ib.buildcmd_name("overlay.apply")
+class apply(object):
+    def run(self, s, src, root, rules_path, variant=None, variants=(), jobs=None):
+        if jobs is None:
+            jobs = ib.scheduler.default_jobs()
+        files = plan(src, rules(rules_path), variant, variants)
+        for d in sorted(set(os.path.dirname(root + f[1]) for f in files)):
+            missing = []
+            while not os.path.isdir(d):
+                missing.insert(0, d)
+                d = os.path.dirname(d)
+            for d in missing:
+                ib.file.install_dir(s, d, 0, 0, 0o755)
+        s.debug("Installing %d overlay files from %s on %d workers", len(files), src, jobs)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(lambda f: install(f[0], root + f[1], *f[2:]), files))
+        for (from_path, target, uid, gid, mode), method in zip(files, results):
+            s.debug("%s %s (uid: %d, gid: %d, perm: %04o)", method, target, uid, gid, mode)
+        self.counts = { m: results.count(m) for m in ("reflink", "copy", "skipped") }
+        s.info("Overlay %s: %d reflinked, %d copied, %d unchanged", src,
+                self.counts["reflink"], self.counts["copy"], self.counts["skipped"])
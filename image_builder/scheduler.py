@@ -0,0 +1,81 @@
+import image_builder as ib
+import concurrent.futures
+import os
+
+def default_jobs():
+    jobs = int(os.getenv('BUILD_JOBS', '0'))
+    if jobs <= 0:
+        jobs = os.cpu_count() or 1
+    return jobs
+
+def depends(command):
+    return getattr(command, 'buildcmd_depends', ())
+
+def graph(targets):
+    nodes = []
+    visiting = set()
+    def visit(command):
+        if command in nodes:
+            return
+        if command in visiting:
+            raise ib.BuilderError("Dependency cycle involving %s" % command.__name__)
+        visiting.add(command)
+        for d in depends(command):
+            visit(d)
+        visiting.remove(command)
+        nodes.append(command)
+    for t in targets:
+        visit(t)
+    return nodes
+
+@ib.buildcmd()
+@ib.buildcmd_name("scheduler.run")
+class run(object):
+    def run(self, s, targets, *args, jobs=None, **kwargs):
+        if jobs is None:
+            jobs = default_jobs()
+        nodes = graph(targets)
+        pending = {n: set(depends(n)) for n in nodes}
+        done = set()
+        running = {}
+        failure = None
+
+        s.debug("Scheduling %d buildcmds on %d workers", len(nodes), jobs)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            while pending or running:
+                if failure is None:
+                    for n in [n for n, d in pending.items() if d <= done]:
+                        del pending[n]
+                        running[pool.submit(n, s.fork(), *args, **kwargs)] = n
+                elif not running:
+                    break
+                finished, _ = concurrent.futures.wait(running,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                for f in finished:
+                    n = running.pop(f)
+                    if f.exception() is not None:
+                        if failure is None:
+                            failure = f.exception()
+                    else:
+                        done.add(n)
+        if failure is not None:
+            raise failure
+
+@ib.buildcmd()
+@ib.buildcmd_name("scheduler.each")
+class each(object):
+    def run(self, s, command, items, *args, jobs=None, **kwargs):
+        if jobs is None:
+            jobs = default_jobs()
+        failure = None
+
+        s.debug("Running %s for %d items on %d workers", command.__name__, len(items), jobs)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            running = [ pool.submit(command, s.fork(), item, *args, **kwargs) for item in items ]
+            for f in concurrent.futures.as_completed(running):
+                if f.exception() is not None and failure is None:
+                    failure = f.exception()
+                    for other in running:
+                        other.cancel()
+        if failure is not None:
+            raise failure
@@ -0,0 +1,102 @@
+import image_builder as ib
+import json
+import logging
+import os
+import threading
+import time
+
+class _Tracer(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.events = []
+        self.pid = os.getpid()
+
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def begin(self, name, parent, args, kwargs):
+        stack = self.stack()
+        if parent is None and stack:
+            parent = stack[-1]
+        event = {
+            "name": name,
+            "parent": parent,
+            "tid": threading.get_ident(),
+            "start": time.time(),
+            "end": None,
+            "children": 0.0,
+            "args": {
+                "args": [ repr(a)[:200] for a in args ],
+                "kwargs": { k: repr(v)[:200] for k, v in kwargs.items() },
+            },
+        }
+        stack.append(event)
+        return event
+
+    def end(self, event, status, extra=None):
+        event["end"] = time.time()
+        event["args"]["status"] = status
+        if extra:
+            event["args"].update(extra)
+        stack = self.stack()
+        if stack and stack[-1] is event:
+            stack.pop()
+        parent = event["parent"]
+        with self.lock:
+            if parent is not None:
+                parent["children"] += event["end"] - event["start"]
+            self.events.append(event)
+
+    def chrome_trace(self):
+        with self.lock:
+            events = list(self.events)
+        if events:
+            origin = min(e["start"] for e in events)
+        out = []
+        for e in events:
+            out.append({
+                "name": e["name"],
+                "cat": "buildcmd",
+                "ph": "X",
+                "ts": int((e["start"] - origin) * 1000000),
+                "dur": int((e["end"] - e["start"]) * 1000000),
+                "pid": self.pid,
+                "tid": e["tid"],
+                "args": e["args"],
+            })
+        return { "traceEvents": out, "displayTimeUnit": "ms" }
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+    def summary(self):
+        totals = {}
+        with self.lock:
+            events = list(self.events)
+        for e in events:
+            count, total, own = totals.get(e["name"], (0, 0.0, 0.0))
+            duration = e["end"] - e["start"]
+            totals[e["name"]] = (count + 1, total + duration, own + max(0.0, duration - e["children"]))
+        return sorted(((total, own, count, name) for name, (count, total, own) in totals.items()),
+                reverse=True)
+
+tracer = _Tracer()
+
+def report():
+    path = os.getenv('BUILD_TRACE')
+    if path:
+        tracer.write(path)
+    rows = tracer.summary()[:int(os.getenv('BUILD_TRACE_TOP', '15'))]
+    if not rows:
+        return
+    logger = logging.getLogger('image_builder')
+    logger.info("Slowest buildcmds:")
+    logger.info("  %10s %10s %6s  %s", "total (s)", "self (s)", "calls", "buildcmd")
+    for total, own, count, name in rows:
+        logger.info("  %10.2f %10.2f %6d  %s", total, own, count, name)
+    if path:
+        logger.info("Wrote trace to %s", path)
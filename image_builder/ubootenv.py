@@ -0,0 +1,150 @@
+import image_builder as ib
+import hashlib
+import os
+import re
+import struct
+import threading
+import zlib
+
+IDENT = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+INCLUDE = re.compile(r'^\s*#\s*include\s*["<]([^">]+)[">]')
+DIRECTIVE = re.compile(r"^\s*#\s*(include|define|undef|ifdef|ifndef|if|elif|else|endif|error)\b\s*(.*)$")
+
+memo = {}
+memo_lock = threading.Lock()
+
+def find_include(name, current, include_path):
+    for d in [ os.path.dirname(current) ] + list(include_path):
+        path = os.path.join(d, name)
+        if os.path.isfile(path):
+            return path
+    raise ib.BuilderError("%s: can't find include file %s" % (current, name))
+
+def sources(path, include_path=(), seen=None):
+    if seen is None:
+        seen = []
+    with open(path, "rb") as f:
+        data = f.read()
+    seen.append((path, data))
+    for line in data.decode('utf-8').splitlines():
+        m = INCLUDE.match(line)
+        if m:
+            sources(find_include(m.group(1), path, include_path), include_path, seen)
+    return seen
+
+def expand(text, defines, depth=0):
+    if not defines or depth > 32:
+        return text
+    parts = text.split('"')
+    for i in range(0, len(parts), 2):
+        parts[i] = IDENT.sub(lambda m: expand(defines[m.group(0)], defines, depth + 1)
+                if m.group(0) in defines else m.group(0), parts[i])
+    return '"'.join(parts)
+
+def evaluate(expr, defines, where):
+    expr = re.sub(r"defined\s*\(\s*(\w+)\s*\)|defined\s+(\w+)",
+            lambda m: "1" if (m.group(1) or m.group(2)) in defines else "0", expr)
+    expr = IDENT.sub(lambda m: m.group(0) if m.group(0) in ("and", "or", "not") else "0",
+            expand(expr, defines))
+    expr = expr.replace("&&", " and ").replace("||", " or ")
+    expr = re.sub(r"!(?!=)", " not ", expr)
+    if not re.match(r"^[\s0-9a-fA-FxX()+\-*/%<>=!andornt]*$", expr):
+        raise ib.BuilderError("%s: unsupported #if expression" % where)
+    try:
+        return bool(eval(expr, { "__builtins__": {} }))
+    except Exception:
+        raise ib.BuilderError("%s: can't evaluate #if expression" % where)
+
+def preprocess(path, defines, include_path, out):
+    with open(path, "r") as f:
+        text = f.read()
+    text = re.sub(r"/\*.*?\*/", lambda m: "\n" * m.group(0).count("\n"), text, flags=re.S)
+    text = re.sub(r"\\[ \t]*\n", "", text)
+    # each entry: (this branch active, some branch already taken, parent active)
+    stack = []
+    active = True
+    for n, line in enumerate(text.split("\n"), 1):
+        where = "%s:%d" % (path, n)
+        m = DIRECTIVE.match(line)
+        if not m:
+            if active:
+                out.append(expand(line, defines))
+            continue
+        directive, arg = m.group(1), m.group(2).strip()
+        if directive in ("ifdef", "ifndef", "if"):
+            if directive == "if":
+                cond = evaluate(arg, defines, where) if active else False
+            else:
+                cond = (arg.split()[0] in defines) == (directive == "ifdef")
+            stack.append((active and cond, active and cond, active))
+            active = active and cond
+        elif directive in ("elif", "else"):
+            if not stack:
+                raise ib.BuilderError("%s: #%s without #if" % (where, directive))
+            current, taken, parent = stack.pop()
+            cond = not taken and parent
+            if directive == "elif" and cond:
+                cond = evaluate(arg, defines, where)
+            stack.append((cond, taken or cond, parent))
+            active = cond
+        elif directive == "endif":
+            if not stack:
+                raise ib.BuilderError("%s: #endif without #if" % where)
+            active = stack.pop()[2]
+        elif not active:
+            continue
+        elif directive == "include":
+            name = INCLUDE.match(line).group(1)
+            preprocess(find_include(name, path, include_path), defines, include_path, out)
+        elif directive == "define":
+            m = re.match(r"^(\w+)(\()?\s*(.*)$", arg)
+            if not m:
+                raise ib.BuilderError("%s: malformed #define" % where)
+            if m.group(2):
+                raise ib.BuilderError("%s: function-like macros are not supported" % where)
+            defines[m.group(1)] = m.group(3)
+        elif directive == "undef":
+            defines.pop(arg.split()[0], None)
+        elif directive == "error":
+            raise ib.BuilderError("%s: #error %s" % (where, arg))
+    if stack:
+        raise ib.BuilderError("%s: unterminated #if" % path)
+
+def parse(path, defines=None, include_path=()):
+    lines = []
+    preprocess(path, dict(defines or {}), include_path, lines)
+    result = []
+    for line in lines:
+        line = re.sub(r"(^|[^\\])#.*", r"\1", line).rstrip()
+        line = line.replace("\\#", "#")
+        if line.strip():
+            result.append(line)
+    return result
+
+def image_bytes(lines, size, pad=0):
+    data = b"".join(line.encode('utf-8') + b"\0" for line in lines)
+    if len(data) + 1 > size - 4:
+        raise ib.BuilderError("Environment needs %d bytes but only %d are available" % (len(data) + 1, size - 4))
+    data += bytes([ pad ]) * (size - 4 - len(data))
+    return struct.pack("<I", zlib.crc32(data)) + data
+
+@ib.buildcmd()
+@ib.buildcmd_name("ubootenv.image")
+class image(object):
+    def run(self, s, src, output, size=16384, defines=None, include_path=(), pad=0):
+        h = hashlib.sha256()
+        for path, data in sources(src, include_path):
+            h.update(path.encode('utf-8') + b"\0" + data + b"\0")
+        h.update(repr(sorted((defines or {}).items())).encode('utf-8'))
+        key = (h.hexdigest(), size, pad)
+        with memo_lock:
+            blob = memo.get(key)
+        if blob is None:
+            blob = image_bytes(parse(src, defines, include_path), size, pad)
+            with memo_lock:
+                memo[key] = blob
+        else:
+            s.debug("Reusing environment image for %s (%d bytes)", src, size)
+        s.debug("Writing %s from %s", output, src)
+        with open(output, "wb") as f:
+            f.write(blob)